@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+"""
+Microbenchmarks of OptionManager hot paths.
+
+    $ python benchmarks.py [name ...]
+
+"""
+import sys
+import timeit
+
+import runtests  # configures settings
+
+
+def setup_database():
+    from django.core.management import call_command
+    call_command('syncdb', interactive=False, verbosity=0)
+
+
+def report(name, number, seconds):
+    print('%-40s %10.2f us/op' % (name, seconds * 1e6 / number))
+
+
+def bench_decode(number=20000):
+    """
+    Cost of the first access of an autoloaded option.
+    """
+    from picklefield.fields import dbsafe_encode
+    from django_options.models import Option
+
+    raw = dbsafe_encode({'title': 'My website', 'menu': ['home', 'blog', 'about']})
+    manager = Option.objects
+
+    report('decode with model instance', number,
+           timeit.timeit(lambda: Option(value=raw).value, number=number))
+    report('decode with field', number,
+           timeit.timeit(lambda: manager.decode(raw), number=number))
+
+
+def bench_get_option(number=20000):
+    """
+    Cost of a cached get_option.
+    """
+    from django_options.models import Option
+
+    manager = Option.objects
+    manager.clear()
+    manager.update_option('bench', 'value')
+
+    report('get_option cached', number,
+           timeit.timeit(lambda: manager.get_option('bench'), number=number))
+    report('get_option missing', number,
+           timeit.timeit(lambda: manager.get_option('bench-missing'), number=number))
+
+
+def bench_codec(number=20000):
+    """
+    Decode cost and row size of values for every available codec.
+    """
+    from django.core.exceptions import ImproperlyConfigured
+    from django_options.codec import get_codec
+    from django_options.models import Option
+
+    field = Option._meta.get_field('value')
+    codec = field.codec
+    values = {
+        'int': 42,
+        'text': u'My website',
+        'menu': {'title': u'My website', 'menu': [u'home', u'blog', u'about'], 'size': 3},
+    }
+    try:
+        for name in ('pickle', 'json', 'msgpack'):
+            try:
+                field.codec = get_codec(name)
+            except ImproperlyConfigured:
+                print('%s not available' % name)
+                continue
+            for kind, value in sorted(values.items()):
+                raw = field.get_db_prep_value(value)
+                report('decode %s %s (%d bytes)' % (name, kind, len(raw)), number,
+                       timeit.timeit(lambda: field.to_python(raw), number=number))
+    finally:
+        field.codec = codec
+
+
+def bench_copy(number=20000):
+    """
+    Cost of the private copy of a written value.
+    """
+    import copy
+    from django_options.utils.frozen import freeze
+
+    value = {'title': u'My website', 'menu': [u'home', u'blog', u'about'], 'size': 3}
+    frozen = freeze(value)
+
+    report('deepcopy', number, timeit.timeit(lambda: copy.deepcopy(value), number=number))
+    report('freeze', number, timeit.timeit(lambda: freeze(value), number=number))
+    report('freeze of frozen value', number, timeit.timeit(lambda: freeze(frozen), number=number))
+
+
+def bench_schema(number=20000):
+    """
+    Cost of a read of an option declared in a schema.
+    """
+    from django_options.models import Option
+    from django_options.schema import OptionSchema, OptionField
+
+    class BenchOptions(OptionSchema):
+        bench = OptionField(basestring, 'value')
+
+    manager = Option.objects
+    manager.clear()
+    options = BenchOptions()
+
+    report('schema attribute', number,
+           timeit.timeit(lambda: options.bench, number=number))
+
+
+def bench_template(number=2000):
+    """
+    Cost of rendering option tags with a literal key, bound to a handle,
+    and with a variable one.
+    """
+    from django.template import Template, Context
+    from django_options.models import Option
+
+    manager = Option.objects
+    manager.clear()
+    manager.update_option('bench', 'value')
+    context = Context({'key': 'bench', 'items': range(10)})
+
+    bound = Template('{% load options %}{% for i in items %}{% option "bench" %}{% endfor %}')
+    report('option tag, literal key x10', number,
+           timeit.timeit(lambda: bound.render(context), number=number))
+    unbound = Template('{% load options %}{% for i in items %}{% option key %}{% endfor %}')
+    report('option tag, variable key x10', number,
+           timeit.timeit(lambda: unbound.render(context), number=number))
+
+
+BENCHMARKS = {
+    'codec': bench_codec,
+    'copy': bench_copy,
+    'decode': bench_decode,
+    'get_option': bench_get_option,
+    'schema': bench_schema,
+    'template': bench_template,
+}
+
+
+if __name__ == '__main__':
+    setup_database()
+    for name in sys.argv[1:] or sorted(BENCHMARKS):
+        BENCHMARKS[name]()
@@ -1,10 +1,23 @@
+from hashlib import md5
+from django.utils.http import urlquote
 from .models import Option
+from .managers import NOT_CACHED
 
 def get_option(key, default=None): return Option.objects.get_option(key,default)
-def add_option(key, value, autoload=True): return Option.objects.add_option(key,value,autoload=autoload)
-def update_option(key, value, autoload=True): return Option.objects.update_option(key,value,autoload=autoload)
+def get_options(keys, defaults=None): return Option.objects.get_options(keys,defaults)
+def peek_option(key, default=None): return Option.objects.peek_option(key,default)
+def add_option(key, value, autoload=True, **kwargs): return Option.objects.add_option(key,value,autoload=autoload,**kwargs)
+def update_option(key, value, autoload=True, **kwargs): return Option.objects.update_option(key,value,autoload=autoload,**kwargs)
 def delete_option(key): return Option.objects.delete_option(key)
+def add_options(options, autoload=True, **kwargs): return Option.objects.add_options(options,autoload=autoload,**kwargs)
+def update_options(options, autoload=True, **kwargs): return Option.objects.update_options(options,autoload=autoload,**kwargs)
+def delete_expired_options(batch_size=1000): return Option.objects.delete_expired_options(batch_size)
+def recode_options(batch_size=1000): return Option.objects.recode_options(batch_size)
 def option_cache_reset(): Option.objects.clear()
+def option_cache_stats(): return Option.objects.cache_stats()
+def option_stats(): return Option.objects.stats()
+def options_version(keys=None): return Option.objects.options_version(keys)
+def options_modified(keys): return Option.objects.options_modified(keys)
 
 # advanced api, not included in OptionManager and maybe experimental
 def option_is(key, expected_value): return get_option(key) == expected_value
@@ -22,3 +35,13 @@ def symbolic_option(key, default=None):
     if not isinstance(link_key,basestring):
         raise AttributeError('Invalid link_key type "%s" for symbolic_option' % type(link_key))
     return get_option(link_key, default)
+
+def options_cache_key(fragment_name, keys, vary_on=()):
+    """
+    Key of a fragment cached by the cache_with_options template tag,
+    changed by a change of the options of keys:
+
+    html = cache.get(options_cache_key('sidebar', ['site_title'], [user.pk]))
+    """
+    args = md5(u':'.join([options_version(keys)] + [urlquote(var) for var in vary_on]))
+    return 'template.cache.%s.%s' % (fragment_name, args.hexdigest())
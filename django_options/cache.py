@@ -0,0 +1,128 @@
+"""
+Shared cache tier of OptionManager, between the in-process caches and the
+database, on a cache configured in CACHES:
+
+    OPTIONS_CACHE = 'default'
+    OPTIONS_CACHE_TIMEOUT = 60 * 60  # default timeout of the cache if None
+
+A fresh process loads the snapshot of options in one round trip instead of
+a table scan. The snapshot is tagged with the site version and every option
+with its own version, both bumped by writes after the database is changed:
+entries filled by a reader that raced with a writer carry an old version
+and are ignored.
+"""
+import time
+from hashlib import md5
+from django.conf import settings
+
+
+class SharedCache(object):
+
+    def __init__(self, cache, timeout=None, prefix='django_options'):
+        self.cache = cache
+        self.timeout = timeout
+        self.prefix = prefix
+
+    def _timeout(self):
+        if self.timeout is None:
+            return {}
+        return {'timeout': self.timeout}
+
+    def version_key(self, site_id, key=None):
+        if key is None:
+            return '%s:%s:version' % (self.prefix, site_id)
+        return '%s:%s:version:%s' % (self.prefix, site_id, md5(key.encode('utf-8')).hexdigest())
+
+    def snapshot_key(self, site_id, loader):
+        return '%s:%s:snapshot:%s' % (self.prefix, site_id, loader)
+
+    def option_key(self, site_id, key):
+        # safe for every backend, whatever is the option key
+        return '%s:%s:option:%s' % (self.prefix, site_id, md5(key.encode('utf-8')).hexdigest())
+
+    def _version(self, version_key, values):
+        version = values.get(version_key)
+        if version is None:
+            # never reuse an old version if the counter is evicted
+            self.cache.add(version_key, int(time.time() * 1000), **self._timeout())
+            version = self.cache.get(version_key)
+        return version
+
+    def _incr(self, version_key):
+        try:
+            return self.cache.incr(version_key)
+        except ValueError:
+            return self._version(version_key, {})
+
+    def get_snapshot(self, site_id, loader):
+        """
+        Return the current version and cached rows, or None if not cached.
+        """
+        snapshot_key = self.snapshot_key(site_id, loader)
+        values = self.cache.get_many([self.version_key(site_id), snapshot_key])
+        version = self._version(self.version_key(site_id), values)
+        snapshot = values.get(snapshot_key)
+        if snapshot is None or snapshot[0] != version:
+            return version, None
+        return version, snapshot[1]
+
+    def set_snapshot(self, site_id, loader, version, rows):
+        self.cache.set(self.snapshot_key(site_id, loader), (version, rows), **self._timeout())
+
+    def get_options(self, site_id, keys):
+        """
+        Return versions and cached entries by key, as (found, value, expires_at).
+        """
+        cache_keys = []
+        for key in keys:
+            cache_keys += [self.version_key(site_id, key), self.option_key(site_id, key)]
+        values = self.cache.get_many(cache_keys)
+
+        versions = {}
+        entries = {}
+        for key in keys:
+            version = versions[key] = self._version(self.version_key(site_id, key), values)
+            entry = values.get(self.option_key(site_id, key))
+            if entry is not None and entry[0] == version:
+                entries[key] = entry[1:]
+        return versions, entries
+
+    def add_options(self, site_id, versions, entries):
+        """
+        Cache entries read from database, tagged with versions read before the query.
+        """
+        self.cache.set_many(dict(
+            (self.option_key(site_id, key), (versions[key],) + tuple(entry)) for key, entry in entries.items()
+        ), **self._timeout())
+
+    def changed(self, site_id, keys, entries):
+        """
+        Bump versions after a write of keys, and cache the written entries.
+        """
+        self._incr(self.version_key(site_id))
+        values = {}
+        for key in keys:
+            version = self._incr(self.version_key(site_id, key))
+            if key in entries:
+                values[self.option_key(site_id, key)] = (version,) + tuple(entries[key])
+        self.cache.set_many(values, **self._timeout())
+
+
+def get_shared_cache(alias=None):
+    """
+    SharedCache on the cache configured by OPTIONS_CACHE,
+    returns None if not configured.
+    """
+    alias = alias or getattr(settings, 'OPTIONS_CACHE', None)
+    if not alias:
+        return None
+
+    try:
+        from django.core.cache import caches
+        cache = caches[alias]
+    except ImportError:
+        # django < 1.7
+        from django.core.cache import get_cache
+        cache = get_cache(alias)
+
+    return SharedCache(cache, getattr(settings, 'OPTIONS_CACHE_TIMEOUT', None))
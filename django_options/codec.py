@@ -0,0 +1,132 @@
+"""
+Codecs of option values, stored in the text column of Option.value.
+
+    OPTIONS_VALUE_CODEC = 'json'  # 'pickle' (default), 'json' or 'msgpack'
+
+Encoded values start with the tag of their codec, so rows written with any
+codec can be read whatever is the configured one. Untagged rows and values
+that the codec can't represent exactly (tuples, dates, objects...) are
+pickled as before. With python 2, json and msgpack read strings as unicode.
+
+Existing rows are encoded again with ``python manage.py options --recode``.
+"""
+import json
+from base64 import b64decode, b64encode
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from .utils.frozen import FrozenDict, FrozenList
+
+
+def is_plain(value):
+    """
+    Whether a value is made only of types that json and msgpack restore.
+    """
+    if value is None or isinstance(value, (bool, basestring)):
+        return True
+    if type(value) in (int, long, float):
+        return True
+    if type(value) in (list, FrozenList):
+        for item in value:
+            if not is_plain(item):
+                return False
+        return True
+    if type(value) in (dict, FrozenDict):
+        for key, item in value.items():
+            if not isinstance(key, basestring) or not is_plain(item):
+                return False
+        return True
+    return False
+
+
+class PickleCodec(object):
+    """
+    Values are pickled by PickledObjectField.
+    """
+    name = 'pickle'
+    tag = None
+
+    def encode(self, value):
+        return None
+
+
+class JSONCodec(object):
+    name = 'json'
+    tag = '~json~'
+
+    def encode(self, value):
+        if not is_plain(value):
+            return None
+        try:
+            return self.tag + json.dumps(value, separators=(',', ':'))
+        except (TypeError, ValueError, UnicodeDecodeError):
+            return None
+
+    def decode(self, data):
+        return json.loads(data[len(self.tag):])
+
+
+class MsgpackCodec(object):
+    name = 'msgpack'
+    tag = '~msgpack~'
+
+    def __init__(self):
+        try:
+            import msgpack
+        except ImportError:
+            raise ImproperlyConfigured('msgpack is required by the msgpack codec of options')
+        self.msgpack = msgpack
+
+    def encode(self, value):
+        if not is_plain(value):
+            return None
+        try:
+            return self.tag + b64encode(self.msgpack.packb(value, use_bin_type=True)).decode('ascii')
+        except (TypeError, ValueError, UnicodeDecodeError):
+            return None
+
+    def decode(self, data):
+        try:
+            return self.msgpack.unpackb(b64decode(data[len(self.tag):].encode('ascii')), raw=False)
+        except Exception, e:
+            raise ValueError(e)
+
+
+CODECS = {
+    'pickle': PickleCodec,
+    'json': JSONCodec,
+    'msgpack': MsgpackCodec,
+}
+
+TAGS = dict((codec_class.tag, name) for name, codec_class in CODECS.items() if codec_class.tag)
+
+_codecs = {}
+
+
+def get_codec(name=None):
+    """
+    Codec by name, or the one configured by OPTIONS_VALUE_CODEC.
+    """
+    name = name or getattr(settings, 'OPTIONS_VALUE_CODEC', 'pickle')
+    codec = _codecs.get(name)
+    if codec is None:
+        if name not in CODECS:
+            raise ImproperlyConfigured('OPTIONS_VALUE_CODEC must be one of %s, not "%s"' % (', '.join(sorted(CODECS)), name))
+        codec = _codecs[name] = CODECS[name]()
+    return codec
+
+
+def is_encoded(data):
+    """
+    Whether a string starts with the tag of a codec.
+    """
+    return data[:1] == '~' and data[:data.find('~', 1) + 1] in TAGS
+
+
+def get_decoder(data):
+    """
+    Codec of a tagged value, or None.
+    """
+    if data[:1] != '~':
+        return None
+    name = TAGS.get(data[:data.find('~', 1) + 1])
+    return name and get_codec(name)
@@ -0,0 +1,73 @@
+"""
+Context processor adding the options of the site to templates:
+
+    TEMPLATE_CONTEXT_PROCESSORS += ('django_options.context_processors.options',)
+
+then ``{{ options.site_title }}`` renders an option. Values are read at
+first use and kept for the rest of the request.
+"""
+from .models import Option
+
+_missing = object()
+
+
+class OptionsProxy(object):
+    """
+    Dict-like access to options, read when first used and kept by the
+    proxy. Missing options raise KeyError, or AttributeError as attributes.
+
+    Keys expected with expect() are read together with the first read key.
+    """
+
+    def __init__(self, manager=None):
+        self._manager = manager
+        self._values = {}
+        self._expected = set()
+
+    def expect(self, keys):
+        values = self._values
+        self._expected.update(key for key in keys if key not in values)
+
+    def _read(self, key):
+        values = self._values
+        value = values.get(key, _missing)
+        if value is not _missing:
+            return value
+
+        manager = self._manager or Option.objects
+        expected = self._expected
+        if expected:
+            # a single lookup, fetching not cached options with a single query
+            expected.add(key)
+            keys = list(expected)
+            expected.clear()
+            values.update(manager.get_options(keys, _missing))
+            value = values.setdefault(key, _missing)
+        else:
+            value = values[key] = manager.handle(key).get(_missing)
+        return value
+
+    def __getitem__(self, key):
+        value = self._read(key)
+        if value is _missing:
+            raise KeyError(key)
+        return value
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        value = self._read(name)
+        if value is _missing:
+            raise AttributeError(name)
+        return value
+
+    def __contains__(self, key):
+        return self._read(key) is not _missing
+
+    def get(self, key, default=None):
+        value = self._read(key)
+        return default if value is _missing else value
+
+
+def options(request):
+    return {'options': OptionsProxy()}
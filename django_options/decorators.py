@@ -1,5 +1,6 @@
 from functools import wraps
 from django.utils.decorators import decorator_from_middleware
+from django.views.decorators.http import condition
 
 def with_options(loader=None, unloader=None):
     """
@@ -25,3 +26,31 @@ def with_options(loader=None, unloader=None):
 #            return response
 #        return wraps(fn)(wrapped)
 #    return inner_decoration
+
+def condition_on_options(keys=None):
+    """
+    Answer conditional requests of a view with 304 Not Modified, using the ETag
+    and Last-Modified of the options it depends on, without calling it.
+
+    keys are the names of the options, or a function of the request and the
+    view arguments returning them. If None, the view depends on all the
+    options of the site and only the ETag is used.
+    """
+    from .models import Option
+
+    def get_keys(request, *args, **kwargs):
+        if callable(keys):
+            return keys(request, *args, **kwargs)
+        return keys
+
+    def etag(request, *args, **kwargs):
+        return Option.objects.options_version(get_keys(request, *args, **kwargs))
+
+    def last_modified(request, *args, **kwargs):
+        view_keys = get_keys(request, *args, **kwargs)
+        if view_keys is None:
+            # the last update goes back when the last updated option is deleted
+            return None
+        return Option.objects.options_modified(view_keys)
+
+    return condition(etag_func=etag, last_modified_func=last_modified)
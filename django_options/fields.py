@@ -0,0 +1,77 @@
+from picklefield.fields import PickledObjectField, PickledObject
+from .codec import get_codec, get_decoder, is_encoded
+from .utils.frozen import thaw
+
+
+class EncodedValue(unicode):
+    """
+    A string that looks encoded by a codec or pickled, as seen by to_python:
+    it is decoded only when loaded from the database (see OptionQuerySet),
+    as strings assigned to the field are kept.
+    """
+
+    def __reduce__(self):
+        return unicode, (unicode(self),)
+
+
+class OptionValueField(PickledObjectField):
+    """
+    PickledObjectField that encodes values with the codec configured by
+    OPTIONS_VALUE_CODEC, falling back on pickle.
+
+    Values written with a codec are decoded only as loaded from the database,
+    strings that look encoded are always written encoded, so they are never
+    mistaken for an encoded value.
+    """
+
+    def __init__(self, *args, **kwargs):
+        # resolved at first write if None
+        self.codec = kwargs.pop('codec', None)
+        super(OptionValueField, self).__init__(*args, **kwargs)
+
+    def decode(self, value):
+        """
+        Value of a column loaded from the database.
+        """
+        if isinstance(value, basestring) and not isinstance(value, PickledObject):
+            decoder = get_decoder(value)
+            if decoder is not None:
+                try:
+                    return decoder.decode(value)
+                except ValueError:
+                    return unicode(value)
+        return super(OptionValueField, self).to_python(value)
+
+    def to_python(self, value):
+        # with django < 1.8 also called on assignment, so values can't be decoded here
+        if isinstance(value, basestring) and not isinstance(value, (EncodedValue, PickledObject)):
+            # pickles are decoded by PickledObjectField
+            if is_encoded(value) or super(OptionValueField, self).to_python(value) is not value:
+                return EncodedValue(value)
+            return value
+        return super(OptionValueField, self).to_python(value)
+
+    def from_db_value(self, value, expression, connection, context):
+        return self.decode(value)
+
+    def get_db_prep_value(self, value, connection=None, prepared=False):
+        if isinstance(value, EncodedValue):
+            value = unicode(value)
+        if value is not None and not isinstance(value, PickledObject):
+            # frozen values are read-only copies of plain ones
+            value = thaw(value)
+            if self.codec is None:
+                self.codec = get_codec()
+            data = self.codec.encode(value)
+            if data is not None:
+                return data
+        return super(OptionValueField, self).get_db_prep_value(value, connection=connection, prepared=prepared)
+
+
+# South support, as PickledObjectField
+try:
+    from south.modelsinspector import add_introspection_rules
+except ImportError:
+    pass
+else:
+    add_introspection_rules([], [r"^django_options\.fields\.OptionValueField"])
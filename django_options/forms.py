@@ -2,7 +2,7 @@ from django import forms
 from django.conf import settings
 from django.contrib.admin.helpers import Fieldset
 
-from . import update_option, get_option, delete_option
+from . import update_options, get_option, delete_option
 from .const import REQUEST_CODE_KEY, SEPARATOR, TITLE_SEPARATOR
 from .helpers import AdminElement
 
@@ -48,7 +48,7 @@ class OptionsForm(forms.Form, AdminElement):
         return cls.page.full_title() + TITLE_SEPARATOR + (cls.title or cls.code.title())
 
     def save(self):
-        results = []
+        values = {}
         for key in self.get_option_fields():
             # save all options
             value = self.cleaned_data[key]
@@ -73,9 +73,10 @@ class OptionsForm(forms.Form, AdminElement):
                 default_storage.save( path, value )
                 value = path
 
-            update_option( self._get_key(key) , value)
-#            results.append((key,update_option(key, value)))
-#        return dict(results)
+            values[ self._get_key(key) ] = value
+
+        # all options in a single transaction
+        return update_options( values )
 
 
     def get_option_fields(self):
@@ -0,0 +1,279 @@
+"""
+Cross-process invalidation of OptionManager caches.
+
+Every write made through OptionManager publishes the changed keys on a
+backend, every other process polls the backend and drops only those keys
+from its caches.
+
+    OPTIONS_INVALIDATION_BACKEND = 'django_options.invalidation.FileInvalidationBackend'
+    OPTIONS_INVALIDATION_BACKEND_OPTIONS = {'path': '/var/run/myproject/options.bus'}
+    OPTIONS_INVALIDATION_INTERVAL = 1.0  # seconds between two polls
+
+Processes on several hosts can share the OptionGeneration table with
+DatabaseInvalidationBackend, polling once per request with
+OptionsLoaderMiddleware and ``OPTIONS_INVALIDATION_INTERVAL = None``.
+
+"""
+import os
+import json
+import time
+import tempfile
+from hashlib import md5
+from datetime import timedelta
+from django.conf import settings
+from django.db.models import Q
+from django.core.exceptions import ImproperlyConfigured
+from django.utils.importlib import import_module
+
+
+class BaseInvalidationBackend(object):
+    """
+    Interface of invalidation backends.
+
+    An instance is owned by a single manager (in a single process), so it
+    can keep its read position without locking.
+    """
+
+    def __init__(self, **options):
+        self.options = options
+
+    @property
+    def origin(self):
+        # pid changes after fork, so workers of a preloaded app are distinct
+        return '%d-%d' % (os.getpid(), id(self))
+
+    def publish(self, site_id, keys):
+        """
+        Notify other processes that ``keys`` of ``site_id`` are changed.
+        """
+        raise NotImplementedError
+
+    def poll(self, site_id):
+        """
+        Return keys of ``site_id`` changed by other processes since last poll,
+        or None if the change set is unknown and all caches must be dropped.
+        """
+        raise NotImplementedError
+
+
+class DummyInvalidationBackend(BaseInvalidationBackend):
+    """
+    Does nothing, every process keeps its own caches.
+    """
+
+    def publish(self, site_id, keys):
+        pass
+
+    def poll(self, site_id):
+        return ()
+
+
+class FileInvalidationBackend(BaseInvalidationBackend):
+    """
+    Uses an append-only file shared by all processes of a host.
+
+    Every change is a json line ``[origin, site_id, key]``. Readers keep the
+    offset of the last line read, so a poll without changes costs a single
+    ``stat``. When the file grows over ``max_bytes`` it is replaced by an
+    empty one and readers drop all their caches. Without ``path`` the file
+    is named after the settings module and the database.
+    """
+
+    def __init__(self, path=None, max_bytes=1024 * 1024, **options):
+        super(FileInvalidationBackend, self).__init__(**options)
+        self.path = path or self.default_path()
+        self.max_bytes = max_bytes
+        self._inode, self._offset = self._position()
+
+    @staticmethod
+    def default_path():
+        """
+        A file in the temporary directory for each settings module and
+        database, so projects of a host don't invalidate each other.
+        """
+        database = settings.DATABASES.get('default', {})
+        namespace = '%s:%s:%s' % (getattr(settings, 'SETTINGS_MODULE', None),
+                                  database.get('HOST', ''), database.get('NAME', ''))
+        return os.path.join(tempfile.gettempdir(), 'django_options.%s.invalidation' % md5(namespace).hexdigest()[:12])
+
+    def _position(self):
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            return None, 0
+        return st.st_ino, st.st_size
+
+    def publish(self, site_id, keys):
+        origin = self.origin
+        data = ''.join(json.dumps([origin, site_id, key]) + '\n' for key in keys)
+        if not data:
+            return
+
+        f = open(self.path, 'a')
+        try:
+            f.write(data)
+            f.flush()
+            st = os.fstat(f.fileno())
+        finally:
+            f.close()
+
+        inode, size = self._position()
+        if inode != st.st_ino:
+            # file rotated while writing, repeat on the new one
+            return self.publish(site_id, keys)
+        if size > self.max_bytes:
+            self._rotate()
+
+    def _rotate(self):
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(self.path) or None)
+        os.close(fd)
+        os.rename(tmp_path, self.path)
+
+    def poll(self, site_id):
+        inode, size = self._position()
+
+        if inode != self._inode or size < self._offset:
+            # rotated or removed: changes in between are lost
+            self._inode, self._offset = inode, size
+            return None
+
+        if size == self._offset:
+            return ()
+
+        f = open(self.path, 'r')
+        try:
+            f.seek(self._offset)
+            data = f.read(size - self._offset)
+        finally:
+            f.close()
+
+        # consume only complete lines, the last one can be still in writing
+        data = data[:data.rfind('\n') + 1]
+        self._offset += len(data)
+
+        origin = self.origin
+        keys = set()
+        for line in data.splitlines():
+            try:
+                line_origin, line_site_id, key = json.loads(line)
+            except ValueError:
+                continue
+            if line_origin != origin and line_site_id == site_id:
+                keys.add(key)
+        return keys
+
+
+class DatabaseInvalidationBackend(BaseInvalidationBackend):
+    """
+    Uses the OptionGeneration table, shared by all processes of all hosts.
+
+    Every change is a row and its primary key is the options generation.
+    A poll is a single indexed lookup of the rows after the last generation
+    seen, which is also the set of changed keys.
+
+    Primary keys are allocated when rows are inserted, not when they are
+    committed, so a row can become visible after a greater one. Primary keys
+    skipped by a poll are polled again for ``overlap`` seconds, longer
+    transactions must not publish changes.
+    Rows older than ``retention`` seconds are pruned every ``prune_every``
+    publications; a process that did not poll for so long drops all caches.
+    """
+
+    def __init__(self, retention=24 * 60 * 60, prune_every=100, overlap=60, **options):
+        super(DatabaseInvalidationBackend, self).__init__(**options)
+        self.retention = retention
+        self.prune_every = prune_every
+        self.overlap = overlap
+        self.generation = None
+        # skipped primary keys, not committed yet or rolled back, and when seen
+        self.gaps = {}
+        self.polled_at = None
+        self.published = 0
+
+    @property
+    def model(self):
+        from .models import OptionGeneration
+        return OptionGeneration
+
+    def current_generation(self):
+        from django.db.models import Max
+        return self.model.objects.aggregate(generation=Max('pk'))['generation'] or 0
+
+    def publish(self, site_id, keys):
+        origin = self.origin
+        self.model.objects.bulk_create([
+            self.model(site_id=site_id, key=key, origin=origin) for key in keys
+        ])
+
+        self.published += 1
+        if self.prune_every and not self.published % self.prune_every:
+            self.prune()
+
+    def prune(self):
+        from django.utils import timezone
+        threshold = timezone.now() - timedelta(seconds=self.retention)
+        self.model.objects.filter(created_at__lt=threshold).delete()
+
+    def poll(self, site_id):
+        now = time.time()
+        expired = self.polled_at is not None and now - self.polled_at > self.retention
+        self.polled_at = now
+
+        if self.generation is None or expired:
+            # older changes are unknown
+            unknown = self.generation is not None
+            self.generation = self.current_generation()
+            self.gaps = {}
+            return None if unknown else ()
+
+        gaps = self.gaps
+        for generation, seen_at in gaps.items():
+            if now - seen_at > self.overlap:
+                # rolled back, or committed too late to be noticed
+                del gaps[generation]
+
+        # all sites, otherwise changes of other sites would look like gaps
+        condition = Q(pk__gt=self.generation)
+        if gaps:
+            condition |= Q(pk__in=list(gaps))
+        changes = self.model.objects.filter(condition).order_by('pk')
+
+        keys = set()
+        origin = self.origin
+        for generation, change_site_id, change_origin, key in changes.values_list('pk', 'site', 'origin', 'key'):
+            if generation > self.generation:
+                for skipped in xrange(self.generation + 1, generation):
+                    gaps[skipped] = now
+                self.generation = generation
+            else:
+                gaps.pop(generation, None)
+            if change_site_id == site_id and change_origin != origin:
+                keys.add(key)
+        return keys
+
+
+def get_invalidation_backend(path=None, **options):
+    """
+    Instantiate backend configured by OPTIONS_INVALIDATION_BACKEND,
+    returns None if not configured.
+    """
+    path = path or getattr(settings, 'OPTIONS_INVALIDATION_BACKEND', None)
+    if not path:
+        return None
+    if not options:
+        options = getattr(settings, 'OPTIONS_INVALIDATION_BACKEND_OPTIONS', {})
+
+    try:
+        module_name, class_name = path.rsplit('.', 1)
+    except ValueError:
+        raise ImproperlyConfigured('%s isn\'t an invalidation backend module' % path)
+    try:
+        mod = import_module(module_name)
+    except ImportError, e:
+        raise ImproperlyConfigured('Error importing invalidation backend %s: "%s"' % (module_name, e))
+    try:
+        backend_class = getattr(mod, class_name)
+    except AttributeError:
+        raise ImproperlyConfigured('Invalidation backend module "%s" does not define a "%s" class' % (module_name, class_name))
+
+    return backend_class(**options)
@@ -0,0 +1,226 @@
+"""
+Template loader that fetches, with a single query, the options that a
+template reads with literal keys before it renders:
+
+    TEMPLATE_LOADERS = (
+        ('django_options.loaders.Loader', (
+            'django.template.loaders.filesystem.Loader',
+            'django.template.loaders.app_directories.Loader',
+        )),
+    )
+
+Keys are collected from the ``option`` and ``cache_with_options`` tags,
+the ``option`` and ``or_option`` filters, variables of the ``options``
+context processor like ``options.site_title``, and the included and
+extended templates with a literal name, once per compiled template (wrap
+the cached loader to compile templates once).
+"""
+from django.template.base import Node, FilterExpression, Variable, Template, TemplateDoesNotExist
+from django.template.loader import get_template
+from django.template.loader_tags import ExtendsNode, IncludeNode
+from django.template.smartif import TokenBase
+try:
+    # django >= 1.8, loaders are bound to a template engine
+    from django.template.loaders.base import Loader as BaseLoader
+    get_template_from_string = find_template_loader = make_origin = None
+except ImportError:
+    from django.template.loader import BaseLoader, get_template_from_string, find_template_loader, make_origin
+try:
+    from django.template.loader_tags import ConstantIncludeNode
+except ImportError:
+    # django >= 1.7, literal names are included by IncludeNode too
+    ConstantIncludeNode = None
+from .models import Option
+from .context_processors import OptionsProxy
+from .templatetags.options import OptionNode, do_get_option_filter, do_or_option_filter
+
+
+def _expressions(value):
+    """
+    Filter expressions in an attribute of a node.
+    """
+    if isinstance(value, FilterExpression):
+        yield value
+    elif isinstance(value, (list, tuple)):
+        for item in value:
+            for expression in _expressions(item):
+                yield expression
+    elif isinstance(value, dict):
+        for item in value.values():
+            for expression in _expressions(item):
+                yield expression
+    elif isinstance(value, TokenBase):
+        # conditions of if tags
+        for name in ('value', 'first', 'second'):
+            for expression in _expressions(getattr(value, name, None)):
+                yield expression
+
+
+def _is_literal(expression):
+    return isinstance(expression.var, basestring) and not expression.filters
+
+
+def collect_option_keys(nodelist, proxy_keys=None):
+    """
+    Literal keys of options read by the nodes of a template. Keys read
+    through the options proxy are added to proxy_keys too.
+    """
+    keys = set()
+    if proxy_keys is None:
+        proxy_keys = set()
+    for node in nodelist.get_nodes_by_type(Node):
+        if isinstance(node, OptionNode):
+            if node.handle is not None:
+                keys.add(node.handle.key)
+            continue
+
+        # as the cache_with_options tag
+        keys.update(getattr(node, 'option_keys', ()))
+
+        if isinstance(node, ExtendsNode):
+            if _is_literal(node.parent_name):
+                try:
+                    parent = _unwrap(get_template(node.parent_name.var))
+                    keys.update(template_option_keys(parent))
+                    proxy_keys.update(parent.option_proxy_keys)
+                except TemplateDoesNotExist:
+                    pass
+        elif ConstantIncludeNode is not None and isinstance(node, ConstantIncludeNode):
+            if node.template is not None:
+                included = _unwrap(node.template)
+                keys.update(template_option_keys(included))
+                proxy_keys.update(included.option_proxy_keys)
+        elif isinstance(node, IncludeNode) and isinstance(node.template, FilterExpression) and _is_literal(node.template):
+            try:
+                included = _unwrap(get_template(node.template.var))
+                keys.update(template_option_keys(included))
+                proxy_keys.update(included.option_proxy_keys)
+            except TemplateDoesNotExist:
+                pass
+
+        for value in node.__dict__.values():
+            for expression in _expressions(value):
+                var = expression.var
+                if isinstance(var, Variable) and var.lookups and len(var.lookups) > 1 and var.lookups[0] == 'options':
+                    proxy_keys.add(var.lookups[1])
+                for position, (func, args) in enumerate(expression.filters):
+                    if func is do_get_option_filter and not position and isinstance(expression.var, basestring):
+                        keys.add(expression.var)
+                    elif func is do_or_option_filter and args and not args[0][0] and isinstance(args[0][1], basestring):
+                        keys.add(args[0][1])
+
+    keys.update(proxy_keys)
+    keys = set(key.strip() for key in keys)
+    keys.discard('')
+    return frozenset(keys)
+
+
+def _unwrap(template):
+    # templates of this loader, and of template backends (django >= 1.8)
+    while not isinstance(template, Template) and hasattr(template, 'template'):
+        template = template.template
+    return template
+
+
+def template_option_keys(template):
+    """
+    Keys of collect_option_keys, kept by the template with the ones
+    read through the options proxy.
+    """
+    keys = getattr(template, 'option_keys', None)
+    if keys is None:
+        proxy_keys = set()
+        keys = collect_option_keys(template.nodelist, proxy_keys)
+        template.option_proxy_keys = frozenset(proxy_keys)
+        template.option_keys = keys
+    return keys
+
+
+def prefetch_template_options(template, context=None):
+    """
+    Fetch options read by a template, the ones not cached with a single query.
+    Nothing is read while options don't change.
+
+    The options proxy of the context resolves the keys of the template
+    together, when the first one is read.
+    """
+    keys = template_option_keys(template)
+    if context is not None and template.option_proxy_keys:
+        proxy = context.get('options')
+        if isinstance(proxy, OptionsProxy):
+            proxy.expect(template.option_proxy_keys)
+    manager = Option.objects
+    epoch = manager.epoch
+    if keys and getattr(template, 'options_epoch', None) != epoch:
+        manager.get_options(list(keys))
+        template.options_epoch = epoch
+
+
+class OptionTemplate(object):
+    """
+    Template that prefetches its options before rendering.
+    """
+
+    def __init__(self, template):
+        self.template = template
+
+    def __getattr__(self, name):
+        return getattr(self.template, name)
+
+    def render(self, context):
+        prefetch_template_options(self.template, context)
+        return self.template.render(context)
+
+    def _render(self, context):
+        # parents of extending templates are rendered with _render
+        prefetch_template_options(self.template, context)
+        return self.template._render(context)
+
+
+class Loader(BaseLoader):
+    is_usable = True
+
+    def __init__(self, *args):
+        # (loaders), or (engine, loaders) with django >= 1.8
+        super(Loader, self).__init__(*args[:-1])
+        self._loaders = args[-1]
+        self._cached_loaders = []
+
+    @property
+    def loaders(self):
+        # resolved on demand to avoid circular imports, as the cached loader
+        if not self._cached_loaders:
+            engine = getattr(self, 'engine', None)
+            find = find_template_loader if engine is None else engine.find_template_loader
+            self._cached_loaders = [find(loader) for loader in self._loaders]
+        return self._cached_loaders
+
+    def load_template(self, template_name, template_dirs=None):
+        engine = getattr(self, 'engine', None)
+        for loader in self.loaders:
+            try:
+                template, display_name = loader(template_name, template_dirs)
+            except TemplateDoesNotExist:
+                continue
+            if engine is None:
+                origin = make_origin(display_name, loader, template_name, template_dirs)
+            else:
+                origin = engine.make_origin(display_name, loader, template_name, template_dirs)
+            if not hasattr(template, 'render'):
+                try:
+                    if engine is None:
+                        template = get_template_from_string(template, origin, template_name)
+                    else:
+                        template = Template(template, origin, template_name, engine)
+                except TemplateDoesNotExist:
+                    # as the cached loader, let the missing template be reported
+                    return template, origin
+            if not isinstance(template, OptionTemplate):
+                template = OptionTemplate(template)
+            return template, None
+        raise TemplateDoesNotExist(template_name)
+
+    def reset(self):
+        for loader in self.loaders:
+            if hasattr(loader, 'reset'):
+                loader.reset()
@@ -19,10 +19,29 @@ class Command(BaseCommand):
         make_option('--eval', action='store_true', dest='eval', default=False, help='Evaluate value to add or update'),
         make_option('--json', action='store_true', dest='json', default=False, help='JSON value provided to add or update'),
         make_option('-d','--delete', action='store_true', dest='delete', default=False, help='Delete option with key provided'),
+        make_option('--ttl', action='store', dest='ttl', type=int, default=None, help='Seconds before added or updated option expires'),
+        make_option('--purge-expired', action='store_true', dest='purge_expired', default=False, help='Delete expired options'),
+        make_option('--stats', action='store_true', dest='stats', default=False, help='Show sizes of options, and metrics of loading them'),
+        make_option('--recode', action='store_true', dest='recode', default=False, help='Encode again all values with OPTIONS_VALUE_CODEC'),
+        make_option('--batch-size', action='store', dest='batch_size', type=int, default=1000, help='Options deleted in a single query by --purge-expired, or encoded in a single transaction by --recode'),
     )
 
     def handle(self, *args, **options):
 
+        if options['purge_expired']:
+            deleted = delete_expired_options( options['batch_size'] )
+            self.stdout.write('Deleted %d expired options' % deleted )
+            return
+
+        if options['stats']:
+            self.show_stats( options.get('per-page') )
+            return
+
+        if options['recode']:
+            recoded = recode_options( options['batch_size'] )
+            self.stdout.write('Encoded %d options' % recoded )
+            return
+
         if not len(args) or options['list']:
 
             page = options.get('page')
@@ -35,12 +54,12 @@ class Command(BaseCommand):
 
         if options['value_to_add']:
             value, action = self.read_value(options['value_to_add'], *args[1:], **options)
-            if not add_option( option_key, value ):
+            if not add_option( option_key, value, ttl=options['ttl'] ):
                 raise CommandError("Cannot add '%s' option, already exists" % option_key)
             self.stdout.write('Add %s: %s %s' % ( option_key, value, action) )
         elif options['value_to_update']:
             value, action = self.read_value(options['value_to_update'], *args[1:], **options)
-            if not update_option( option_key, value ):
+            if not update_option( option_key, value, ttl=options['ttl'] ):
                 raise CommandError("Cannot update '%s' option with '%s'" % (option_key,value))
             self.stdout.write('Update %s: %s %s' % ( option_key, value, action ) )
         elif options['delete']:
@@ -77,6 +96,53 @@ class Command(BaseCommand):
         if page and paginator.num_pages > 1:
             self.stdout.write(u'\nPage %s of %s' % (page,paginator.num_pages))
 
+    def show_stats(self, top=25):
+
+        from django.utils import timezone
+        sites = {}
+        sizes = []
+        now = timezone.now()
+        for site_id, key, value, autoload, expires_at in Option.all.values_list('site', 'key', 'value', 'autoload', 'expires_at').iterator():
+            size = len(value or '')
+            site = sites.setdefault(site_id, [0, 0, 0, 0])
+            site[0] += 1
+            site[1] += autoload and 1 or 0
+            site[2] += expires_at is not None and expires_at <= now and 1 or 0
+            site[3] += size
+            sizes.append((size, site_id, key, autoload))
+
+        x = PrettyTable(["Site", "Options", "Autoload", "Expired", "Bytes"])
+        for site_id, (count, autoloaded, expired, size) in sorted(sites.items()):
+            x.add_row([site_id, count, autoloaded, expired, size])
+        self.stdout.write(u"\n%s" % x)
+
+        x = PrettyTable(["Site", "Largest option", "Bytes", "Autoload"])
+        x.align["Largest option"] = "l"
+        for size, site_id, key, autoload in sorted(sizes, reverse=True)[:top]:
+            x.add_row([site_id, key, size, autoload])
+        self.stdout.write(u"\n%s" % x)
+
+        # metrics of this process
+        import time
+        Option.objects.clear()
+        started = time.time()
+        Option.objects.fetch_all_options()
+        load_time = time.time() - started
+        stats = option_stats()
+
+        x = PrettyTable(["Metric", "Value"])
+        x.align["Metric"] = "l"
+        for name, value in sorted(stats['counters'].items()):
+            x.add_row([name, value])
+        for name, timer in sorted(stats['timers'].items()):
+            x.add_row(['%s (count / mean ms / max ms)' % name, '%d / %.2f / %.2f' % (timer['count'], timer['mean'] * 1000, timer['max'] * 1000)])
+        for name, cache in sorted(stats['caches'].items()):
+            if isinstance(cache, dict):
+                x.add_row(['%s (size / capacity)' % name, '%s / %s' % (cache['size'], cache['capacity'])])
+        x.add_row(['loaded options', len(Option.objects.all_options)])
+        x.add_row(['load time (ms)', '%.2f' % (load_time * 1000)])
+        self.stdout.write(u"\n%s" % x)
+
     def show_option_value(self, option_key):
         opt = Option.objects.get(key=option_key)
 
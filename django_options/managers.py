@@ -1,8 +1,210 @@
 import copy
+import time
+import cPickle as pickle
+import threading
+from datetime import timedelta
+from functools import wraps
+from hashlib import md5
 from django.contrib.sites.managers import CurrentSiteManager
 from django.conf import settings
-from django.db import IntegrityError
+from django.core.exceptions import ImproperlyConfigured
+from django.db import IntegrityError, connection, transaction
+from django.db.models import Count, Max, Min, Manager
+from django.db.models.query import QuerySet
+from django.utils import timezone
 from .signals import option_value_changed
+from .invalidation import get_invalidation_backend
+from .cache import get_shared_cache
+from .metrics import get_metrics
+from .snapshot import OptionSnapshot
+from .utils.lru import LRUCache
+from .utils.frozen import freeze
+from .fields import EncodedValue
+
+# lookup results: not cached and not existing options
+_missing = object()
+_absent = object()
+# returned by peek_option for options that are not cached
+NOT_CACHED = object()
+
+
+class DecodedValue(object):
+    """
+    Wraps a value written by this process in all_options,
+    where values are stored not decoded.
+    """
+    __slots__ = ('value',)
+
+    def __init__(self, value):
+        self.value = value
+
+class Flight(object):
+    """
+    A query in flight, for keys fetched by a thread while others wait.
+    """
+    __slots__ = ('seq', 'event', 'values')
+
+    def __init__(self, seq):
+        self.seq = seq
+        self.event = threading.Event()
+        self.values = None
+
+class LazyValue(object):
+    """
+    Stands for a value in all_options that is fetched on first access,
+    loaded values are over OPTIONS_LAZY_THRESHOLD bytes.
+    """
+    __slots__ = ('size',)
+
+    def __init__(self, size):
+        self.size = size
+
+    def __reduce__(self):
+        # shared cache snapshots are pickled with any protocol
+        return LazyValue, (self.size,)
+
+class OptionHandle(object):
+    """
+    Value of an option bound to its key, read again only when cached
+    options change (see OptionManager.epoch) or the option expires.
+
+    The value is frozen and shared by all callers of get.
+    """
+    __slots__ = ('manager', 'key', 'epoch', 'value', 'deadline', 'digest')
+
+    def __init__(self, manager, key):
+        self.manager = manager
+        self.key = key.strip()
+        self.epoch = None
+        self.value = _absent
+        self.deadline = None
+        # value and its digest, see version
+        self.digest = None
+
+    def get(self, default=None):
+        manager = self.manager
+        snapshot = getattr(manager.local, 'snapshot', None)
+        if snapshot is not None:
+            return snapshot.get_option(self.key, default)
+
+        # drop keys changed elsewhere
+        manager.sync()
+        value = self.value
+        if self.epoch != manager.epoch or self.deadline is not None and time.time() >= self.deadline:
+            # counted by read_option
+            self.load()
+            value = self.value
+        elif manager.metrics is not None and self.key:
+            manager.metrics.read(self.key)
+            manager.metrics.incr('negative_hits' if value is _absent else 'hits')
+
+        return default if value is _absent else value
+
+    def load(self):
+        manager = self.manager
+        # changes while loading are seen at next get
+        epoch = manager.epoch
+        value = manager.read_option(self.key, _absent) if self.key else None
+        self.value = value if value is _absent else freeze(value)
+
+        deadline = None
+        expires_at = manager.expires.get(self.key)
+        if expires_at is not None:
+            now = timezone.now()
+            if expires_at > now:
+                deadline = time.time() + (expires_at - now).total_seconds()
+        self.deadline = deadline
+        self.epoch = epoch
+
+    def version(self):
+        """
+        Digest of the value, the same in every process, '' if missing.
+        """
+        value = self.get(_absent)
+        digest = self.digest
+        if digest is None or digest[0] is not value:
+            if value is _absent:
+                digest = (value, '')
+            else:
+                digest = (value, md5(pickle.dumps(value, pickle.HIGHEST_PROTOCOL)).hexdigest())
+            self.digest = digest
+        return digest[1]
+
+class OptionQuerySet(QuerySet):
+    """
+    QuerySet decoding values written with a codec as instances are loaded,
+    what OptionValueField can't do before django 1.8.
+    """
+
+    def iterator(self):
+        for obj in super(OptionQuerySet, self).iterator():
+            value = obj.__dict__.get('value')
+            if isinstance(value, EncodedValue):
+                obj.__dict__['value'] = obj._meta.get_field('value').decode(value)
+            yield obj
+
+    def raw_values_list(self, *fields):
+        """
+        values_list with the value column as stored, to decode with
+        OptionValueField.decode: django >= 1.8 would decode it already.
+        """
+        if 'value' not in fields:
+            return self.values_list(*fields)
+        column = '%s.%s' % (connection.ops.quote_name(self.model._meta.db_table),
+                            connection.ops.quote_name(self.model._meta.get_field('value').column))
+        fields = tuple('raw_value' if field == 'value' else field for field in fields)
+        return self.extra(select={'raw_value': column}).values_list(*fields)
+
+
+class PlainOptionManager(Manager):
+    """
+    Manager of options of all sites.
+    """
+
+    def get_queryset(self):
+        return OptionQuerySet(self.model, using=self._db)
+
+    get_query_set = get_queryset
+
+# transaction.atomic is available since django 1.6
+atomic = getattr(transaction, 'atomic', None) or transaction.commit_on_success
+
+
+def serialized(method):
+    """
+    Run a method that changes caches holding the writer lock of the manager.
+
+    write_seq is odd while a writer runs, readers of other threads cache what
+    they read only if no writer ran in the meanwhile (see can_cache).
+    """
+    name = method.__name__.lstrip('_')
+
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        metrics = self.metrics
+        if metrics is not None:
+            started = time.time()
+            try:
+                return serialized_call(self, *args, **kwargs)
+            finally:
+                metrics.timing(name, time.time() - started)
+        return serialized_call(self, *args, **kwargs)
+
+    def serialized_call(self, *args, **kwargs):
+        with self.lock:
+            self.writers += 1
+            if self.writers == 1:
+                self.writer = threading.current_thread()
+                self.write_seq += 1
+            try:
+                return method(self, *args, **kwargs)
+            finally:
+                self.writers -= 1
+                if not self.writers:
+                    self.write_seq += 1
+                    self.writer = None
+                    self.epoch += 1
+    return wrapper
 
 class OptionManager(CurrentSiteManager):
     """ Option API """
@@ -13,48 +215,466 @@ class OptionManager(CurrentSiteManager):
 #    site_id = None
 
     def __init__(self, **kwargs):
+        # None means unbounded
+        self.cache_size = getattr(settings, 'OPTIONS_CACHE_SIZE', 10000)
+        self.negative_cache_size = getattr(settings, 'OPTIONS_NEGATIVE_CACHE_SIZE', 1000)
+        self.loader = getattr(settings, 'OPTIONS_LOADER', 'autoload')
+        if self.loader not in ('fallback', 'autoload', 'all'):
+            raise ImproperlyConfigured('OPTIONS_LOADER must be "fallback", "autoload" or "all", not "%s"' % self.loader)
+        self.loader_limit = getattr(settings, 'OPTIONS_LOADER_LIMIT', None)
+        # max bytes of values loaded by fetch_all_options, larger ones are fetched on access (None is unlimited)
+        self.lazy_threshold = getattr(settings, 'OPTIONS_LAZY_THRESHOLD', None)
+        # cache immutable values, safe to share without copies
+        self.freeze_values = getattr(settings, 'OPTIONS_FREEZE_VALUES', False)
+        # counters and timers, None if disabled by OPTIONS_METRICS
+        self.metrics = get_metrics()
+        # max seconds an invalidated value is served while it's fetched again (None is disabled)
+        self.stale_ttl = getattr(settings, 'OPTIONS_STALE_WHILE_REVALIDATE', None)
+        # readers never lock, writers are serialized
+        self.lock = threading.RLock()
+        self.sync_lock = threading.Lock()
+        self.invalidation_lock = threading.Lock()
+        self.writers = 0
+        self.writer = None
+        self.write_seq = 0
+        # changes of cached values, without those made by a writer in progress
+        self.epoch = 0
+        # handles by key, see handle()
+        self.handles = LRUCache(self.cache_size)
+        # update dates by key, and count and last update of the site by None,
+        # valid while the epoch doesn't change, see options_modified
+        self.modified = (None, {})
+        # in-flight fetches by key, and number of queries run and saved
+        self.flights = {}
+        self.flight_lock = threading.Lock()
+        self.fetches = 0
+        self.coalesced = 0
         self.clear()
         self.site_id = kwargs.pop('site_id',None)
-        self.__is_validated = False
+        # managers of other sites, see for_site
+        self.root = self
+        self.sites = LRUCache(getattr(settings, 'OPTIONS_SITE_PARTITIONS', 100))
+        self.sites_lock = threading.Lock()
+        self.invalidation = None
+        self.invalidation_interval = None
+        self.next_sync = None
+        self.value_field = None
+        self.shared_cache = _missing
+        # request snapshots are per thread
+        self.local = threading.local()
         super(OptionManager, self).__init__(**kwargs)
 
     def get_queryset(self):
-        # monkey patch for CurrentSiteManage
-        # that allows to change site_id
-        if not self.site_id:
-            return super(OptionManager, self).get_query_set()
-        return super(CurrentSiteManager, self).get_query_set().filter(**{self.__field_name + '__id__exact': self.site_id})
+        # as CurrentSiteManager, with the site_id of this manager; filters
+        # on the site field itself, as the internals of CurrentSiteManager
+        # change between django versions
+        return OptionQuerySet(self.model, using=self._db).filter(site__id=self.get_site_id())
 
     get_query_set = get_queryset
 
+    def for_site(self, site_id):
+        """
+        Manager of options of another site, with its own caches.
+
+        Managers are created once and kept for the OPTIONS_SITE_PARTITIONS
+        most recently used sites, each one bounded by OPTIONS_CACHE_SIZE.
+        """
+        root = self.root
+        if site_id is None or site_id == root.get_site_id():
+            return root
+
+        manager = root.sites.get(site_id)
+        if manager is None:
+            with root.sites_lock:
+                manager = root.sites.get(site_id)
+                if manager is None:
+                    manager = self.__class__(site_id=site_id)
+                    manager.model = root.model
+                    manager._db = root._db
+                    manager.root = root
+                    root.sites[site_id] = manager
+        return manager
+
+    @serialized
     def clear(self):
         self.all_options = None
-        self.not_options = {}
-        self.single_options = {}
+        self.not_options = LRUCache(self.negative_cache_size)
+        self.single_options = LRUCache(self.cache_size)
+        # expiration dates of cached keys, if any
+        self.expires = {}
+        # invalidated values in revalidation by key, as (value, invalidated at)
+        self.stale = {}
+
+    def can_cache(self, seq):
+        """
+        Whether a value read since write_seq was ``seq`` can be cached:
+        no writer ran in the meanwhile, or the writer is this thread.
+        """
+        if seq != self.write_seq:
+            return False
+        return not seq & 1 or self.writer is threading.current_thread()
 
     def get_site_id(self):
         return self.site_id or settings.SITE_ID
 
+    @property
+    def shared(self):
+        """
+        Shared cache tier configured by OPTIONS_CACHE, or None.
+        """
+        if self.shared_cache is _missing:
+            self.shared_cache = get_shared_cache()
+        return self.shared_cache
+
+    def stats(self):
+        """
+        Counters, timers and most read keys (see OPTIONS_METRICS) with cache_stats().
+        """
+        if self.metrics is None:
+            stats = {'counters': {}, 'timers': {}, 'hot_keys': []}
+        else:
+            stats = self.metrics.stats()
+        stats['caches'] = self.cache_stats()
+        return stats
+
+    def cache_stats(self):
+        """
+        Size, hits, misses and evictions of single_options and not_options,
+        fetches of not cached options and fetches saved by waiting another thread.
+        """
+        return {
+            'single_options': self.single_options.stats(),
+            'not_options': self.not_options.stats(),
+            'fetches': self.fetches,
+            'coalesced': self.coalesced,
+        }
+
+    def forget(self, key):
+        """
+        Drop a key from all caches, next get_option reloads it.
+        """
+        self.not_options.pop(key, None)
+        self.single_options.pop(key, None)
+        self.expires.pop(key, None)
+        self.stale.pop(key, None)
+        all_options = self.all_options
+        if all_options:
+            all_options.pop(key, None)
+
+    def expired(self, key):
+        """
+        Check expiration date of a cached key, an expired key is
+        moved to not_options.
+        """
+        expires_at = self.expires.get(key)
+        if expires_at is None or expires_at > timezone.now():
+            return False
+        self.single_options.pop(key, None)
+        all_options = self.all_options
+        if all_options:
+            all_options.pop(key, None)
+        # expires is kept to know that an expired row exists
+        self.not_options[key] = True
+        self.epoch += 1
+        return True
+
+    def remember_expiry(self, key, expires_at):
+        if expires_at is None:
+            self.expires.pop(key, None)
+        else:
+            self.expires[key] = expires_at
+
+    def configure_invalidation(self):
+        """
+        Configure the invalidation backend, at first sync or write.
+        """
+        with self.invalidation_lock:
+            if self.next_sync is None:
+                self.invalidation = get_invalidation_backend()
+                self.invalidation_interval = getattr(settings, 'OPTIONS_INVALIDATION_INTERVAL', 1.0)
+                if self.invalidation is not None:
+                    # changes are read from now on, before anything is cached
+                    self.invalidation.poll(self.get_site_id())
+                self.next_sync = 0
+
+    def sync(self, force=False):
+        """
+        Reload keys changed by other processes, as published on
+        OPTIONS_INVALIDATION_BACKEND. Polls at most once every
+        OPTIONS_INVALIDATION_INTERVAL seconds (never if None), unless forced.
+        A forced sync of the root manager syncs its partitions of other sites.
+        """
+        if force and self.root is self and self.sites:
+            # OptionsLoaderMiddleware forces only Option.objects
+            for site_id, manager in self.sites.items():
+                manager.sync(force=True)
+
+        if self.next_sync is not None and self.invalidation is None:
+            return
+
+        if not self.sync_lock.acquire(False):
+            # another thread is polling
+            return
+        try:
+            if self.next_sync is None:
+                self.configure_invalidation()
+
+            if self.invalidation is None:
+                return
+
+            now = time.time()
+            if not force and (self.invalidation_interval is None or now < self.next_sync):
+                return
+            self.next_sync = now + (self.invalidation_interval or 0)
+
+            keys = self.invalidation.poll(self.get_site_id())
+            if keys is None:
+                self.clear()
+            elif keys:
+                self.reload(keys)
+        finally:
+            self.sync_lock.release()
+
+    @serialized
+    def reload(self, keys):
+        """
+        Drop keys from caches, changed autoloaded options are
+        fetched again with a single query.
+
+        With OPTIONS_STALE_WHILE_REVALIDATE, cached values are served for
+        that many seconds at most, while they are fetched in background.
+        """
+        stale = {}
+        if self.stale_ttl is not None:
+            now = time.time()
+            for key in keys:
+                # staleness counts from the first invalidation
+                entry = self.stale.get(key)
+                if entry is None:
+                    value = self.cached(key)
+                    if value is not _missing:
+                        entry = (value, now)
+                if entry is not None:
+                    stale[key] = entry
+
+        for key in keys:
+            self.forget(key)
+
+        if stale:
+            self.stale.update(stale)
+            self.spawn(self.revalidate, list(stale))
+            keys = [key for key in keys if key not in stale]
+
+        all_options = self.all_options
+        if all_options is None or not keys:
+            return
+
+        options_db = self.get_query_set().filter(key__in=list(keys), autoload=True)
+        options_db = options_db.exclude(expires_at__lte=timezone.now())
+        for key, value, expires_at in options_db.raw_values_list('key', 'value', 'expires_at'):
+            if self.lazy_threshold is not None and value is not None and len(value) > self.lazy_threshold:
+                value = LazyValue(len(value))
+            all_options[key] = value
+            self.remember_expiry(key, expires_at)
+
+    def cached(self, key):
+        """
+        Cached value of a key, without queries nor changes of caches.
+        """
+        if key in self.not_options:
+            return _absent
+        value = self.single_options.data.get(key, _missing)
+        all_options = self.all_options
+        if value is _missing and all_options:
+            raw_value = all_options.get(key, _missing)
+            if raw_value is not _missing and not isinstance(raw_value, LazyValue):
+                value = self.decode(raw_value)
+        return value
+
+    def spawn(self, target, *args):
+        """
+        Run target in a background thread, with its own database connection.
+        """
+        def run():
+            try:
+                target(*args)
+            finally:
+                connection.close()
+        thread = threading.Thread(target=run)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def revalidate(self, keys):
+        """
+        Fetch again stale keys, option_value_changed is sent for
+        changed values if no write replaced them in the meanwhile.
+        """
+        try:
+            values = self.fetch_options(keys)
+        finally:
+            stale = [(key, self.stale.pop(key, None)) for key in keys]
+            self.epoch += 1
+
+        for key, entry in stale:
+            if entry is None:
+                continue
+            old_value = None if entry[0] is _absent else entry[0]
+            new_value = None if values[key] is _absent else values[key]
+            if old_value != new_value:
+                option_value_changed.send(self, old_value=old_value, new_value=new_value, option=key)
+
+    def stale_value(self, key):
+        """
+        Stale value of a key in revalidation, _missing if none or too old.
+        """
+        entry = self.stale.get(key)
+        if entry is None:
+            return _missing
+        if time.time() - entry[1] > self.stale_ttl:
+            self.stale.pop(key, None)
+            self.epoch += 1
+            return _missing
+        return entry[0]
+
+    def publish(self, *keys):
+        """
+        Notify a write of keys, after the database and caches are changed.
+        """
+        if self.stale:
+            # written meanwhile in revalidation
+            for key in keys:
+                self.stale.pop(key, None)
+
+        if self.next_sync is None:
+            # written before any read
+            self.configure_invalidation()
+        if self.invalidation is not None:
+            self.invalidation.publish(self.get_site_id(), keys)
+
+        shared = self.shared
+        if shared is not None:
+            # write-through of cached values
+            entries = {}
+            for key in keys:
+                if key in self.single_options:
+                    entries[key] = (True, self.single_options[key], self.expires.get(key))
+                elif key in self.not_options:
+                    entries[key] = (False, None, None)
+            shared.changed(self.get_site_id(), keys, entries)
+
     def fetch_all_options(self):
         """
-        Loads and caches all autoloaded options, if available or all options.
+        Loads and caches options, as defined by OPTIONS_LOADER:
+
+        * 'autoload' (default) only autoloaded options, with a single query
+        * 'fallback' autoloaded options, if available or all options with a second query
+        * 'all' all options, with a single query
+
+        OPTIONS_LOADER_LIMIT caps the number of loaded options, autoloaded and
+        last updated first. Expired options are not loaded. Values over
+        OPTIONS_LAZY_THRESHOLD bytes are fetched on first access.
         """
+        all_options = self.all_options
+        if all_options is None:
+            all_options = self.load_all_options()
+        return all_options
+
+    @serialized
+    def load_all_options(self):
         if self.all_options is None:
+            # not loaded by another thread in the meanwhile
 
-            all_options_db = self.get_query_set().filter(autoload=True).values()
+            all_options = {}
 
-            if not any(all_options_db):
-                # try to load all
-                all_options_db = self.get_query_set().all().values()
+            if self.metrics is not None:
+                self.metrics.incr('queries')
 
-            self.all_options = {}
+            shared = self.shared
+            if shared is None:
+                rows = self.scan_options()
+            else:
+                site_id, loader = self.get_site_id(), '%s-%s-%s' % (self.loader, self.loader_limit, self.lazy_threshold)
+                version, rows = shared.get_snapshot(site_id, loader)
+                if rows is None:
+                    rows = list(self.scan_options())
+                    shared.set_snapshot(site_id, loader, version, rows)
 
             # store not decoded values
-            for opt in all_options_db:
-                self.all_options[opt['key']] = opt['value']
+            for key, value, expires_at in rows:
+                all_options[key] = value
+                if expires_at is not None:
+                    self.expires[key] = expires_at
+
+            # readers see the whole set of options, or nothing
+            self.all_options = all_options
 
         return self.all_options
 
+    def scan_options(self):
+        """
+        Stream rows to load as (key, value, expires_at), in chunks.
+        Values over lazy_threshold bytes are not read, but only their size.
+        """
+        options_db = self.get_query_set().exclude(expires_at__lte=timezone.now())
+        fields = ('key', 'value', 'expires_at', 'autoload')
+        if self.lazy_threshold is not None:
+            column = '%s.%s' % (connection.ops.quote_name(self.model._meta.db_table), connection.ops.quote_name('value'))
+            options_db = options_db.extra(select={
+                'value_size': 'LENGTH(%s)' % column,
+                'eager_value': 'CASE WHEN LENGTH(%s) > %d THEN NULL ELSE %s END' % (column, int(self.lazy_threshold), column),
+            })
+            fields = ('key', 'eager_value', 'expires_at', 'autoload', 'value_size')
+
+        if self.loader in ('autoload', 'fallback'):
+            found = False
+            for option in self.scan_rows(options_db.filter(autoload=True), fields):
+                found = True
+                yield option
+            if found or self.loader == 'autoload':
+                return
+            # no autoloaded options, fallback on all
+        for option in self.scan_rows(options_db, fields):
+            yield option
+
+    def scan_rows(self, options_db, fields):
+        rows = options_db.raw_values_list(*fields)
+        if self.loader_limit:
+            # autoloaded and most recently updated ones
+            rows = rows.order_by('-autoload', '-updated_at')[:self.loader_limit]
+        for row in rows.iterator():
+            key, value, expires_at = row[:3]
+            if value is None and len(row) > 4 and row[4] is not None:
+                value = LazyValue(row[4])
+            yield key, value, expires_at
+
+    def snapshot(self):
+        """
+        A request-scoped view of options, to use as context manager.
+        """
+        return OptionSnapshot(self)
+
+    def begin_snapshot(self, snapshot=None):
+        """
+        Serve reads and buffer writes of this thread with a snapshot,
+        until end_snapshot().
+        """
+        # a snapshot not ended by a broken request, its writes are dropped
+        self.end_snapshot(discard=True)
+        self.local.snapshot = snapshot or self.snapshot()
+        return self.local.snapshot
+
+    def end_snapshot(self, discard=False):
+        """
+        Flush buffered writes of the active snapshot of this thread,
+        or drop them if discard is True.
+        """
+        snapshot = getattr(self.local, 'snapshot', None)
+        if snapshot is not None:
+            self.local.snapshot = None
+            if not discard:
+                snapshot.flush()
+
     def get_option(self, key, default= None):
         """
         Retrieve option value based on name of option.
@@ -64,44 +684,367 @@ class OptionManager(CurrentSiteManager):
 
         If the option was serialized then it will be unserialized when it is returned.
 
+        Expired options are handled as not existing.
+
         :param key option Name of option to retrieve. Expected to not be SQL-escaped.
         :param default Optional. Default value to return if the option does not exist.
         :return mixed Value set for the option or None if not exists.
         """
+        snapshot = getattr(self.local, 'snapshot', None)
+        if snapshot is not None:
+            return snapshot.get_option(key, default)
+        return self.read_option(key, default)
+
+    def read_option(self, key, default= None):
+        """
+        get_option, ignoring the snapshot of this thread.
+        """
 
         # clean key option
         key = key.strip()
         if not key: return None
 
-        # already misses?
-        if key in self.not_options: return default
+        # drop keys changed elsewhere
+        self.sync()
 
-        self.fetch_all_options()
+        if self.metrics is not None:
+            self.metrics.read(key)
 
-        if key in self.single_options:
-            value = self.single_options[key]
+        value = self.lookup(key)
+        if value is _absent:
+            return default
+        if value is not _missing:
+            return value
 
-        elif key in self.all_options:
-            value = self.get_query_set().model( value=self.all_options[key] ).value
-            # to prevent double decoding
-            self.single_options[key] = value
+        value = self.fetch_options([key])[key]
+        if value is _absent:
+            return default
 
-        else:
-            try:
-                opt = self.get_query_set().get( key=key )
-                # already deserialized
-                value = opt.value
-                # remember that
-                self.single_options[ key ] = value
+        # maybe deserialize json
+        return value
 
-            except self.get_query_set().model.DoesNotExist:
-                self.not_options[key] = True
-                return default
+    def peek_option(self, key, default=None):
+        """
+        get_option served only by caches, ignoring the snapshot of this
+        thread: NOT_CACHED if the option must be fetched, never a query.
 
-        # maybe deserialize json
+        Code that must not block, as an event loop, reads hits inline and
+        misses with get_option in a thread, where concurrent misses of a
+        key share a single query.
+        """
+        key = key.strip()
+        if not key: return default
+        if self.all_options is None:
+            # loading is a query
+            return NOT_CACHED
+
+        if self.metrics is not None:
+            self.metrics.read(key)
+
+        value = self.lookup(key)
+        if value is _absent:
+            return default
+        if value is _missing:
+            return NOT_CACHED
         return value
 
+    def lookup(self, key):
+        """
+        Retrieve option value from caches, without queries except the
+        first fetch_all_options.
+
+        :return mixed Value of the option, _absent if it does not exist,
+        or _missing if it is not cached.
+        """
+
+        metrics = self.metrics
+
+        # already misses? probed with get only if there, as it counts a miss
+        not_options = self.not_options
+        if key in not_options and not_options.get(key):
+            if metrics is not None: metrics.incr('negative_hits')
+            return _absent
+
+        seq = self.write_seq
+        all_options = self.all_options
+        if all_options is None:
+            all_options = self.fetch_all_options()
+            # the load is a write of this thread, unless cleared in the meanwhile
+            seq = self.write_seq if self.all_options is all_options else None
+
+        # cost nothing without expiring options
+        if self.expires and self.expired(key):
+            return _absent
+
+        value = self.single_options.get(key, _missing)
+        if value is not _missing:
+            if metrics is not None: metrics.incr('hits')
+            return value
+
+        raw_value = all_options.get(key, _missing)
+        if raw_value is not _missing and not isinstance(raw_value, LazyValue):
+            value = self.decode(raw_value)
+            # to prevent double decoding
+            if self.can_cache(seq):
+                self.single_options[key] = value
+            if metrics is not None: metrics.incr('autoload_hits')
+        elif self.stale and self.writer is not threading.current_thread():
+            # writers compare with current values
+            value = self.stale_value(key)
+
+        if value is _missing and metrics is not None:
+            metrics.incr('misses')
+        return value
+
+    def decode(self, raw_value):
+        """
+        Decode a value as loaded by values(), without building a model instance.
+        """
+        if isinstance(raw_value, DecodedValue):
+            return raw_value.value
+        if self.value_field is None:
+            self.value_field = self.model._meta.get_field('value')
+        if self.freeze_values:
+            return freeze(self.value_field.decode(raw_value))
+        return self.value_field.decode(raw_value)
+
+    def copy_value(self, value):
+        """
+        Private copy of a written value: frozen with OPTIONS_FREEZE_VALUES,
+        so immutable parts are shared, or a deep copy.
+        """
+        if self.freeze_values:
+            return freeze(value)
+        return copy.deepcopy(value)
+
+    def handle(self, key):
+        """
+        Handle of an option: its get(default) costs a comparison
+        while options don't change.
+        """
+        handle = self.handles.get(key)
+        if handle is None:
+            handle = self.handles[key] = OptionHandle(self, key)
+        return handle
 
+    def options_version(self, keys=None):
+        """
+        Digest of the values of options, changed by a change of any of them.
+        If keys is None, version of all the options of the site, from their
+        number, last update and next expiry.
+        """
+        if keys is None:
+            count, updated_at, expires_at = self.site_modified()
+            return md5('%d:%s:%s' % (count, updated_at and updated_at.isoformat(),
+                                     expires_at and expires_at.isoformat())).hexdigest()
+        return md5(':'.join([self.handle(key).version() for key in keys])).hexdigest()
+
+    def modified_dates(self):
+        """
+        Update dates cached for the current epoch.
+        """
+        epoch = self.epoch
+        modified = self.modified
+        if modified[0] != epoch:
+            modified = self.modified = (epoch, {})
+        return modified[1]
+
+    def site_modified(self):
+        """
+        Number of not expired options of the site, date of the last update
+        and of the next expiry, read with a query once per change of cached
+        options and at the next expiry.
+        """
+        dates = self.modified_dates()
+        now = timezone.now()
+        site = dates.get(None)
+        if site is None or (site[2] is not None and site[2] <= now):
+            site = self.get_query_set().exclude(expires_at__lte=now).aggregate(
+                count=Count('pk'), updated_at=Max('updated_at'), expires_at=Min('expires_at'))
+            site = dates[None] = (site['count'], site['updated_at'], site['expires_at'])
+        return site
+
+    def options_modified(self, keys):
+        """
+        Date of the last update of options, None if one of them doesn't exist
+        (deleting an option doesn't leave a date). Dates are read with a single
+        query once per change of cached options.
+        """
+        keys = [key.strip() for key in keys]
+        dates = self.modified_dates()
+        now = timezone.now()
+        missing = [key for key in keys if key not in dates]
+        if missing:
+            found = self.get_query_set().filter(key__in=missing).exclude(
+                expires_at__lte=now).values_list('key', 'updated_at', 'expires_at')
+            found = dict((key, (updated_at, expires_at)) for key, updated_at, expires_at in found)
+            for key in missing:
+                dates[key] = found.get(key, (None, None))
+
+        modified = None
+        for key in keys:
+            updated_at, expires_at = dates[key]
+            if updated_at is None or (expires_at is not None and expires_at <= now):
+                return None
+            if modified is None or updated_at > modified:
+                modified = updated_at
+        return modified
+
+    def get_options(self, keys, defaults=None):
+        """
+        Retrieve values of several options, all not cached ones
+        are fetched with a single query.
+
+        :param keys list Names of options to retrieve.
+        :param defaults Optional. Dict of default values by name, or the default value of all options.
+        :return dict Values by name of option.
+        """
+        snapshot = getattr(self.local, 'snapshot', None)
+        if snapshot is not None:
+            return snapshot.get_options(keys, defaults)
+        return self.read_options(keys, defaults)
+
+    def read_options(self, keys, defaults=None):
+        """
+        get_options, ignoring the snapshot of this thread.
+        """
+        # keys can be any iterable, they are read more than once
+        keys = list(keys)
+        if not isinstance(defaults, dict):
+            defaults = dict.fromkeys(keys, defaults)
+
+        # drop keys changed elsewhere
+        self.sync()
+
+        values = {}
+        missing = {}
+        metrics = self.metrics
+        for name in keys:
+            key = name.strip()
+            if not key: continue
+            if metrics is not None:
+                metrics.read(key)
+
+            value = self.lookup(key)
+            if value is _absent:
+                values[name] = defaults.get(name)
+            elif value is _missing:
+                # names can differ only by spaces
+                missing.setdefault(key, []).append(name)
+            else:
+                values[name] = value
+
+        if missing:
+            for key, value in self.fetch_options(list(missing)).items():
+                for name in missing[key]:
+                    values[name] = defaults.get(name) if value is _absent else value
+
+        return values
+
+    def fetch_options(self, keys):
+        """
+        Fetch not cached options with query_options, once per process:
+        a key already in flight is waited for, unless a write happened
+        since its fetch started.
+
+        :return dict Value by key, _absent for not existing options.
+        """
+        seq = self.write_seq
+        joined = {}
+        own = []
+        with self.flight_lock:
+            for key in keys:
+                flight = self.flights.get(key)
+                if flight is not None and flight.seq == seq:
+                    joined[key] = flight
+                else:
+                    own.append(key)
+            if own:
+                flight = Flight(seq)
+                for key in own:
+                    self.flights[key] = flight
+                self.fetches += 1
+
+        values = {}
+        if own:
+            try:
+                flight.values = self.query_options(own, seq)
+                values.update(flight.values)
+            finally:
+                with self.flight_lock:
+                    for key in own:
+                        if self.flights.get(key) is flight:
+                            del self.flights[key]
+                flight.event.set()
+
+        for key, flight in joined.items():
+            flight.event.wait()
+            if flight.values is None:
+                # failed, try again
+                values.update(self.fetch_options([key]))
+            else:
+                values[key] = flight.values[key]
+                self.coalesced += 1
+        return values
+
+    def query_options(self, keys, seq):
+        """
+        Fetch options from the shared cache, if configured, and then
+        with a single query, and cache them unless a write happened
+        since write_seq was ``seq``.
+        """
+        site_id = self.get_site_id()
+        shared = self.shared
+        entries = {}
+        if shared is not None:
+            versions, entries = shared.get_options(site_id, keys)
+            if self.freeze_values:
+                for key, (found, value, expires_at) in entries.items():
+                    entries[key] = (found, freeze(value), expires_at)
+
+        metrics = self.metrics
+        if metrics is not None and entries:
+            metrics.incr('shared_hits', len(entries))
+
+        missing = [key for key in keys if key not in entries]
+        if missing:
+            if metrics is not None:
+                metrics.incr('queries')
+                started = time.time()
+            entries_db = dict.fromkeys(missing, (False, None, None))
+            options_db = self.get_query_set().filter(key__in=missing).raw_values_list('key', 'value', 'expires_at')
+            for key, value, expires_at in options_db:
+                if key in entries_db:
+                    entries_db[key] = (True, self.decode(value), expires_at)
+            if metrics is not None:
+                metrics.timing('fetch', time.time() - started)
+            if shared is not None:
+                shared.add_options(site_id, versions, entries_db)
+            entries.update(entries_db)
+
+        if not self.can_cache(seq):
+            # a write raced with the query, values are not cached
+            now = timezone.now()
+            return dict(
+                (key, value if found and (expires_at is None or expires_at > now) else _absent)
+                for key, (found, value, expires_at) in entries.items()
+            )
+
+        values = {}
+        for key, (found, value, expires_at) in entries.items():
+            if found:
+                self.remember_expiry(key, expires_at)
+                if not (self.expires and self.expired(key)):
+                    # remember that
+                    self.single_options[key] = value
+                    values[key] = value
+                    continue
+            self.not_options[key] = True
+            values[key] = _absent
+        return values
+
+
+    @serialized
     def update_option(self, key, new_value, **kwargs):
         """
         Update the value of an option that was already added.
@@ -116,20 +1059,34 @@ class OptionManager(CurrentSiteManager):
 
         :param key string models. Option name. Expected to not be SQL-escaped.
         :param new_value mixed models.Option value. Expected to not be SQL-escaped.
+        :param ttl int Optional. Seconds before the option expires.
+        :param expires_at datetime Optional. When the option expires.
         :return bool False if value was not updated and true if value was updated.
         """
 
+        snapshot = getattr(self.local, 'snapshot', None)
+        if snapshot is not None:
+            return snapshot.update_option(key, new_value, **kwargs)
+
         # clean key option
         key = key.strip()
         if not key: return None
 
-        new_value = copy.deepcopy( new_value )
+        new_value = self.copy_value( new_value )
 
         old_value = self.get_option( key )
 
+        expires_at = self.get_expires_at(kwargs.get('ttl'), kwargs.get('expires_at'))
+
         # If the new and old values are the same, no need to update.
         if new_value == old_value:
-            return False
+            if expires_at is None or old_value is None:
+                return False
+            # only the expiration date
+            self.remember_expiry(key, expires_at)
+            updated = self.get_query_set().filter(key=key).update(expires_at=expires_at) == 1
+            self.publish(key)
+            return updated
 
         # if option not exists, he creates as the deal
         if old_value is None:
@@ -139,19 +1096,30 @@ class OptionManager(CurrentSiteManager):
         if key in self.not_options:
             del self.not_options[key]
 
-        # update caches if needed
-        if key in self.single_options:
-            self.single_options[key] = new_value
-        if key in self.all_options:
-            #self.all_options[key] = new_value
-            del self.all_options[key]
+        # update caches
+        self.single_options[key] = new_value
+        self.fetch_all_options().pop(key, None)
 
         option_value_changed.send(self, old_value=old_value, new_value=new_value, option=key)
 
-        return self.get_query_set().filter(key=key).update(value=new_value) == 1
+        # auto_now is not applied by update
+        fields = {'value': new_value, 'updated_at': timezone.now()}
+        if expires_at is not None:
+            fields['expires_at'] = expires_at
+            self.remember_expiry(key, expires_at)
+
+        updated = self.get_query_set().filter(key=key).update(**fields) == 1
+        self.publish(key)
+        return updated
+
 
+    def get_expires_at(self, ttl=None, expires_at=None):
+        if ttl is not None:
+            return timezone.now() + timedelta(seconds=ttl)
+        return expires_at
 
-    def add_option(self, key, value, autoload=True):
+    @serialized
+    def add_option(self, key, value, autoload=True, ttl=None, expires_at=None):
         """
         Add a new option.
 
@@ -167,27 +1135,39 @@ class OptionManager(CurrentSiteManager):
         :param key str Name of option to add. Expected to not be SQL-escaped.
         :param value mixed models.Optional. models.Option value, can be anything. Expected to not be SQL-escaped.
         :param autoload bool Optional. Default is enabled. Whether to load the option when system starts up.
+        :param ttl int Optional. Seconds before the option expires.
+        :param expires_at datetime Optional. When the option expires, ignored if ttl is provided.
         :return bool False if option was not added and true if option was added.
         """
 
+        snapshot = getattr(self.local, 'snapshot', None)
+        if snapshot is not None:
+            return snapshot.add_option(key, value, autoload=autoload, ttl=ttl, expires_at=expires_at)
+
         # clean key option
         key = key.strip()
         if not key: return None
 
-        value = copy.deepcopy( value )
+        value = self.copy_value( value )
 
         all_options = self.fetch_all_options()
 
         # Make sure the option doesn't already exist.
-        if key in all_options:
+        if key in all_options and not (self.expires and self.expired(key)):
             return False
         # check the 'not_options' cache before we ask for a db query
         if key not in self.not_options:
             if not self.get_option( key ) is None:
                 return False
 
+        if key in self.expires:
+            # replace the expired one
+            self.get_query_set().filter(key=key, expires_at__lte=timezone.now()).delete()
+
+        expires_at = self.get_expires_at(ttl, expires_at)
+
         try:
-            option = self.get_query_set().create(key=key, site_id=self.get_site_id(), value=value, autoload=autoload)
+            option = self.get_query_set().create(key=key, site_id=self.get_site_id(), value=value, autoload=autoload, expires_at=expires_at)
         except IntegrityError:
             return False
 
@@ -201,21 +1181,157 @@ class OptionManager(CurrentSiteManager):
         if key in self.not_options:
             del self.not_options[key]
 
+        self.remember_expiry(key, expires_at)
+
         if autoload:
-            all_options[key] = option.value
-        else:
-            self.single_options[key] = option.value
+            all_options[key] = DecodedValue(option.value)
+        self.single_options[key] = option.value
+
+        self.publish(key)
 
         option_value_changed.send(self, old_value=None, new_value=option.value, option=option.key)
 
         return True
 
 
+    def add_options(self, options, autoload=True, ttl=None, expires_at=None):
+        """
+        Add several new options, inside a single transaction.
+
+        Existing options are not updated, new options are inserted with a single query.
+        Signals are sent after commit.
+
+        :param options dict Values by name of options to add.
+        :param autoload bool Optional. Default is enabled. Whether to load the options when system starts up.
+        :param ttl int Optional. Seconds before the options expire.
+        :param expires_at datetime Optional. When the options expire, ignored if ttl is provided.
+        :return dict True by name of added options, False for existing ones.
+        """
+
+        snapshot = getattr(self.local, 'snapshot', None)
+        if snapshot is not None:
+            return snapshot.add_options(options, autoload=autoload, ttl=ttl, expires_at=expires_at)
+        return self._write_options(options, False, autoload, ttl, expires_at)
+
+    def update_options(self, options, autoload=True, ttl=None, expires_at=None):
+        """
+        Update or add several options, inside a single transaction.
+
+        Values are compared with cached ones (not cached are fetched with a single query),
+        missing options are inserted with a single query and changed ones are updated
+        with a query for each distinct value. Signals are sent after commit.
+
+        :param options dict Values by name of options to update.
+        :param autoload bool Optional. Default is enabled. Whether to load added options when system starts up.
+        :param ttl int Optional. Seconds before the options expire.
+        :param expires_at datetime Optional. When the options expire, ignored if ttl is provided.
+        :return dict True by name of updated options, False for not changed ones.
+        """
+
+        snapshot = getattr(self.local, 'snapshot', None)
+        if snapshot is not None:
+            return snapshot.update_options(options, autoload=autoload, ttl=ttl, expires_at=expires_at)
+        return self._write_options(options, True, autoload, ttl, expires_at)
+
+    @serialized
+    def _write_options(self, options, update, autoload, ttl, expires_at):
+        options = dict((key.strip(), self.copy_value(value)) for key, value in options.items() if key.strip())
+        results = dict.fromkeys(options, False)
+
+        old_values = self.get_options(options.keys())
+        expires_at = self.get_expires_at(ttl, expires_at)
+
+        # None is also the value of existing options, missing ones are known
+        # by the negative cache or else by their rows
+        unknown = [key for key in options if old_values[key] is None and key not in self.not_options]
+        existing = set()
+        if unknown:
+            existing.update(self.get_query_set().filter(key__in=unknown).exclude(
+                expires_at__lte=timezone.now()).values_list('key', flat=True))
+
+        added = {}
+        # pairs of value and keys, to update keys with same value at once
+        changes = []
+        for key, value in options.items():
+            old_value = old_values[key]
+            if old_value is None and key not in existing:
+                if value is not None:
+                    added[key] = value
+            elif update and (value != old_value or expires_at is not None):
+                for change in changes:
+                    if type(change[0]) is type(value) and change[0] == value:
+                        change[1].append(key)
+                        break
+                else:
+                    changes.append((value, [key]))
+
+        if not added and not changes:
+            return results
+
+        now = timezone.now()
+        try:
+            with atomic():
+                expired = [key for key in added if key in self.expires]
+                if expired:
+                    # replace the expired ones
+                    self.get_query_set().filter(key__in=expired, expires_at__lte=now).delete()
+
+                site_id = self.get_site_id()
+                self.model.objects.bulk_create([
+                    self.model(key=key, site_id=site_id, value=value, autoload=autoload, expires_at=expires_at)
+                    for key, value in added.items()
+                ])
+
+                for value, keys in changes:
+                    fields = {'value': value, 'updated_at': now}
+                    if expires_at is not None:
+                        fields['expires_at'] = expires_at
+                    self.get_query_set().filter(key__in=keys).update(**fields)
+        except IntegrityError:
+            # added elsewhere in the meanwhile, nothing is changed
+            for key in added:
+                self.forget(key)
+            return results
+
+        all_options = self.fetch_all_options()
+        signals = []
+        for key, value in added.items():
+            self.not_options.pop(key, None)
+            self.remember_expiry(key, expires_at)
+            if autoload:
+                all_options[key] = DecodedValue(value)
+            self.single_options[key] = value
+            signals.append((key, None, value))
+            results[key] = True
+
+        for value, keys in changes:
+            for key in keys:
+                self.single_options[key] = value
+                all_options.pop(key, None)
+                if expires_at is not None:
+                    self.remember_expiry(key, expires_at)
+                if value != old_values[key]:
+                    signals.append((key, old_values[key], value))
+                results[key] = True
+
+        self.publish(*[key for key, updated in results.items() if updated])
+
+        for key, old_value, new_value in signals:
+            option_value_changed.send(self, old_value=old_value, new_value=new_value, option=key)
+
+        return results
+
+
+    @serialized
     def delete_option(self, key):
         """
         Removes option by name. Prevents removal of protected options.
         """
 
+        snapshot = getattr(self.local, 'snapshot', None)
+        if snapshot is not None:
+            return snapshot.delete_option(key)
+
         # clean key option
         key = key.strip()
         if not key: return None
@@ -226,17 +1342,97 @@ class OptionManager(CurrentSiteManager):
             opt = OptionQuery.get( key=key )
 
             # clean caches
-            if opt.autoload and self.all_options and key in self.all_options:
-                del self.all_options[key]
+            if opt.autoload and self.all_options:
+                self.all_options.pop(key, None)
             if key in self.single_options:
                 del self.single_options[key]
+            self.expires.pop(key, None)
 
             opt.delete()
+            self.not_options[key] = True
 
         except OptionQuery.model().DoesNotExist:
             return False
 
+        self.publish(key)
+
         option_value_changed.send(self, old_value=opt.value, new_value=None, option=opt.key)
 
         return True
 
+    def recode_options(self, batch_size=1000):
+        """
+        Encode again values of all sites with the codec configured by
+        OPTIONS_VALUE_CODEC, in batches of ``batch_size`` rows, each one
+        in a short transaction. A row changed in the meanwhile is skipped.
+        Cached values are not changed.
+
+        :return int Number of encoded options.
+        """
+        from picklefield.fields import PickledObject
+
+        field = self.model._meta.get_field('value')
+        # of all sites
+        options_db = OptionQuerySet(self.model, using=self._db).order_by('pk')
+        recoded = 0
+        last_pk = 0
+        while True:
+            rows = list(options_db.filter(pk__gt=last_pk).raw_values_list('pk', 'value')[:batch_size])
+            if not rows:
+                break
+            last_pk = rows[-1][0]
+
+            with atomic():
+                for pk, raw_value in rows:
+                    if raw_value is None:
+                        continue
+                    value = field.decode(raw_value)
+                    if field.get_db_prep_value(value) == raw_value:
+                        continue
+                    recoded += options_db.filter(pk=pk, value=PickledObject(raw_value)).update(value=value)
+
+            if len(rows) < batch_size:
+                break
+        return recoded
+
+    def delete_expired_options(self, batch_size=1000):
+        """
+        Removes expired options of all sites in batches of ``batch_size``
+        rows, each one in a short query. The writer lock is held only to drop
+        each batch from caches, so writers are never blocked for long.
+        Signals are not sent for expired options.
+
+        :return int Number of deleted options.
+        """
+        # of all sites, as recode_options
+        options_db = OptionQuerySet(self.model, using=self._db)
+        deleted = 0
+        while True:
+            now = timezone.now()
+            expired = list(options_db.filter(expires_at__lte=now).values_list('pk', 'site', 'key')[:batch_size])
+            if not expired:
+                break
+
+            pks = [pk for pk, site_id, key in expired]
+            # an option updated in the meanwhile is not expired anymore
+            options_db.filter(pk__in=pks, expires_at__lte=now).delete()
+
+            keys = {}
+            for pk, site_id, key in expired:
+                keys.setdefault(site_id, []).append(key)
+            for site_id, site_keys in keys.items():
+                self.for_site(site_id).forget_options(site_keys)
+            deleted += len(expired)
+
+            if len(expired) < batch_size:
+                break
+        return deleted
+
+    @serialized
+    def forget_options(self, keys):
+        """
+        Drop keys deleted from the database from caches, and publish them.
+        """
+        for key in keys:
+            self.forget(key)
+        self.publish(*keys)
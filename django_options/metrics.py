@@ -0,0 +1,90 @@
+"""
+Counters and timers of OptionManager, enabled by:
+
+    OPTIONS_METRICS = True
+    OPTIONS_METRICS_HOT_KEYS = 20  # number of most read keys to track (default 0)
+    OPTIONS_METRICS_HOOK = 'myproject.metrics.send'  # called as hook(kind, name, value)
+
+Counters are ``hits`` (decoded values), ``autoload_hits`` (values decoded
+from autoloaded options), ``negative_hits`` (missing options), ``misses``
+(fetched), ``shared_hits`` (fetched from the shared cache) and ``queries``.
+Timers measure queries of ``fetch`` and ``load``, and every write.
+
+The hook receives ``('incr', name, count)`` and ``('timing', name, seconds)``,
+to forward them to statsd or similar. Numbers are updated without locks, so
+they are approximated with threads.
+"""
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.utils.importlib import import_module
+
+
+class OptionMetrics(object):
+
+    def __init__(self, hot_keys=0, hook=None):
+        self.hot_keys = hot_keys
+        self.hook = hook
+        self.reset()
+
+    def reset(self):
+        self.counters = {}
+        # count, total and max seconds by name
+        self.timers = {}
+        self.reads = {}
+
+    def incr(self, name, count=1):
+        self.counters[name] = self.counters.get(name, 0) + count
+        if self.hook is not None:
+            self.hook('incr', name, count)
+
+    def timing(self, name, seconds):
+        timer = self.timers.get(name)
+        if timer is None:
+            timer = self.timers[name] = [0, 0.0, 0.0]
+        timer[0] += 1
+        timer[1] += seconds
+        if seconds > timer[2]:
+            timer[2] = seconds
+        if self.hook is not None:
+            self.hook('timing', name, seconds)
+
+    def read(self, key):
+        """
+        Count a read of key, if hot keys are tracked.
+        """
+        if not self.hot_keys:
+            return
+        reads = self.reads
+        reads[key] = reads.get(key, 0) + 1
+        if len(reads) > self.hot_keys * 10:
+            # keep the most read half, approximated
+            for cold_key, count in sorted(reads.items(), key=lambda item: item[1])[:len(reads) // 2]:
+                reads.pop(cold_key, None)
+
+    def stats(self):
+        return {
+            'counters': dict(self.counters),
+            'timers': dict(
+                (name, {'count': count, 'total': total, 'max': max_time, 'mean': total / count})
+                for name, (count, total, max_time) in self.timers.items()
+            ),
+            'hot_keys': sorted(self.reads.items(), key=lambda item: (-item[1], item[0]))[:self.hot_keys],
+        }
+
+
+def get_metrics():
+    """
+    OptionMetrics configured by OPTIONS_METRICS, returns None if disabled.
+    """
+    if not getattr(settings, 'OPTIONS_METRICS', False):
+        return None
+
+    hook = getattr(settings, 'OPTIONS_METRICS_HOOK', None)
+    if isinstance(hook, basestring):
+        try:
+            module_name, func_name = hook.rsplit('.', 1)
+            hook = getattr(import_module(module_name), func_name)
+        except (ValueError, ImportError, AttributeError), e:
+            raise ImproperlyConfigured('Error importing options metrics hook %s: "%s"' % (hook, e))
+
+    return OptionMetrics(getattr(settings, 'OPTIONS_METRICS_HOT_KEYS', 0), hook)
@@ -11,6 +11,9 @@ class OptionsLoaderMiddleware(object):
 
         self.loaders = []
 
+        # serve reads from a snapshot and buffer writes of each request
+        self.snapshot = getattr(settings, 'OPTIONS_REQUEST_SNAPSHOT', False)
+
         for loader_path in getattr(settings, 'OPTIONS_LOADERS', getattr(settings, 'options_loaders', [])) :
 
             try:
@@ -32,6 +35,13 @@ class OptionsLoaderMiddleware(object):
 
     def process_request(self, request):
 
+        # reload options changed by other processes, once per request
+        from .models import Option
+        Option.objects.sync(force=True)
+
+        if self.snapshot:
+            Option.objects.begin_snapshot()
+
         for loader in self.loaders:
 
             load = getattr(loader, 'load_options', None)
@@ -52,7 +62,19 @@ class OptionsLoaderMiddleware(object):
 
             unload(request, response)
 
+        if self.snapshot:
+            # flush buffered writes
+            from .models import Option
+            Option.objects.end_snapshot()
+
         return response
 
+    def process_exception(self, request, exception):
+
+        if self.snapshot:
+            # drop buffered writes of the failed request
+            from .models import Option
+            Option.objects.end_snapshot(discard=True)
+
 
 
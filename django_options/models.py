@@ -3,8 +3,8 @@ from django.db import models
 from django.utils.translation import ugettext_lazy as _
 from django.contrib.sites.models import Site
 from django.conf import settings
-from picklefield import PickledObjectField
-from .managers import OptionManager
+from .fields import OptionValueField
+from .managers import OptionManager, PlainOptionManager
 
 VALUE_EDITABLE = getattr(settings, 'OPTION_VALUE_EDITABLE', False)
 
@@ -16,7 +16,7 @@ class Option(models.Model):
     key = models.CharField(max_length=255,
                            verbose_name=_('Key'))
 
-    value = PickledObjectField(null=True, default=True,
+    value = OptionValueField(null=True, default=True,
                                verbose_name=_('Value'), 
                                editable=VALUE_EDITABLE)
 
@@ -32,7 +32,7 @@ class Option(models.Model):
 
     # override default manager
     objects = OptionManager()
-    all = models.Manager()
+    all = PlainOptionManager()
     on_site = objects
 
     def __unicode__(self):
@@ -42,3 +42,29 @@ class Option(models.Model):
         unique_together = ('site', 'key',)
         verbose_name = _('Option')
         verbose_name_plural = _('Options')
+
+
+class OptionGeneration(models.Model):
+    """
+    A change of an option, its primary key is the options generation.
+    Used by DatabaseInvalidationBackend.
+    """
+
+    site = models.ForeignKey(Site, related_name='option_generations',
+                             verbose_name=_('Site'))
+
+    key = models.CharField(max_length=255,
+                           verbose_name=_('Key'))
+
+    origin = models.CharField(max_length=64,
+                              verbose_name=_('Origin'))
+
+    created_at = models.DateTimeField(auto_now_add=True, db_index=True,
+                                      verbose_name=_('Create at'))
+
+    def __unicode__(self):
+        return u"{0.pk:d}:{0.key:s}".format(self)
+
+    class Meta:
+        verbose_name = _('Option generation')
+        verbose_name_plural = _('Option generations')
@@ -0,0 +1,196 @@
+"""
+Declarative schema of known options, with typed attribute access.
+
+    from django_options.schema import OptionSchema, OptionField
+
+    class SiteOptions(OptionSchema):
+        site_title = OptionField(basestring, 'My site')
+        items_per_page = OptionField(int, 10, autoload=False)
+        promo_banner = OptionField(basestring, key='promo.banner', ttl=24 * 60 * 60)
+
+    options = SiteOptions()
+    options.site_title
+
+All options of a schema are loaded, converted to their type and stored in
+slots at the first access, and again only after a change of the options
+cached by the manager, so a read is an attribute lookup and a comparison.
+Stored values that can't be converted are read as defaults, written ones
+raise ValueError, and unknown names raise AttributeError. Inside a snapshot
+options are read from the snapshot, with its writes.
+"""
+import time
+from django.core.exceptions import ImproperlyConfigured
+from django.utils import timezone
+
+
+# strings of boolean options, as stored by forms or by hand
+BOOLEAN_STRINGS = {
+    'true': True, '1': True, 'yes': True, 'on': True,
+    'false': False, '0': False, 'no': False, 'off': False, '': False,
+}
+
+
+class OptionField(object):
+    """
+    A known option: type of its value, default value, and autoload
+    and ttl used when the option is written.
+    """
+
+    def __init__(self, type=None, default=None, autoload=True, ttl=None, key=None):
+        self.type = type
+        self.default = default
+        self.autoload = autoload
+        self.ttl = ttl
+        self.key = key
+        self.name = None
+
+    def clean(self, value):
+        """
+        Value converted to the type of the field, the default one if None.
+
+        Raises ValueError if the value can't be converted.
+        """
+        if value is None or self.type is None or isinstance(value, self.type):
+            return self.default if value is None else value
+        if self.type is bool and isinstance(value, basestring):
+            # bool('false') is True
+            try:
+                return BOOLEAN_STRINGS[value.strip().lower()]
+            except KeyError:
+                pass
+        else:
+            try:
+                return self.type(value)
+            except (TypeError, ValueError):
+                pass
+        raise ValueError('Invalid value %r of option "%s", expected %s' % (value, self.key, self.type.__name__))
+
+    def to_python(self, value):
+        """
+        Value converted to the type of the field, or the default one.
+        """
+        try:
+            return self.clean(value)
+        except ValueError:
+            return self.default
+
+
+class OptionAccessor(object):
+    """
+    Reads the slot of an option, after the schema is loaded again if
+    options are changed.
+    """
+    __slots__ = ('field', 'slot')
+
+    def __init__(self, field, slot):
+        self.field = field
+        self.slot = slot
+
+    def __get__(self, obj, cls=None):
+        if obj is None:
+            return self.field
+        snapshot = getattr(obj._manager.local, 'snapshot', None)
+        if snapshot is not None:
+            # as handles, slots hold values outside of snapshots only
+            return self.field.to_python(snapshot.get_option(self.field.key))
+
+        # drop keys changed elsewhere, as reads of the manager
+        obj._manager.sync()
+        if obj._epoch != obj._manager.epoch or obj._deadline is not None and time.time() >= obj._deadline:
+            obj.load()
+        return self.slot.__get__(obj, cls)
+
+    def __set__(self, obj, value):
+        obj.set(self.field.name, value)
+
+
+class SchemaMetaclass(type):
+
+    def __new__(mcs, name, bases, attrs):
+        fields = {}
+        for base in bases:
+            fields.update(getattr(base, 'fields', {}))
+        for attr, field in list(attrs.items()):
+            if isinstance(field, OptionField):
+                del attrs[attr]
+                field.name = attr
+                field.key = field.key or attr
+                if field.type is not None and field.default is not None and not isinstance(field.default, field.type):
+                    raise ImproperlyConfigured('Default value of option "%s" is not a %s' % (field.key, field.type))
+                fields[attr] = field
+
+        attrs['fields'] = fields
+        inherited = [attr for attr in fields if any(attr in getattr(base, 'fields', {}) for base in bases)]
+        attrs['__slots__'] = tuple(attrs.get('__slots__', ())) + tuple('_value_' + attr for attr in fields if attr not in inherited)
+        cls = super(SchemaMetaclass, mcs).__new__(mcs, name, bases, attrs)
+        for attr, field in fields.items():
+            setattr(cls, attr, OptionAccessor(field, getattr(cls, '_value_' + attr)))
+        return cls
+
+
+class OptionSchema(object):
+    """
+    Base class of schemas, bound to ``manager`` (Option.objects by default).
+    """
+    __metaclass__ = SchemaMetaclass
+    __slots__ = ('_manager', '_epoch', '_deadline')
+
+    def __init__(self, manager=None):
+        if manager is None:
+            from .models import Option
+            manager = Option.objects
+        self._manager = manager
+        self._epoch = None
+        self._deadline = None
+
+    def load(self):
+        """
+        Fetch all options of the schema, with a single query for not cached ones.
+        """
+        manager = self._manager
+        # changes while loading are seen at next access, values of a
+        # snapshot are loaded again after it
+        epoch = None if getattr(manager.local, 'snapshot', None) is not None else manager.epoch
+        keys = [field.key for field in self.fields.values()]
+        values = manager.get_options(keys)
+
+        deadline = None
+        now = timezone.now()
+        for attr, field in self.fields.items():
+            setattr(self, '_value_' + attr, field.to_python(values.get(field.key)))
+            # load again when the first option expires
+            expires_at = manager.expires.get(field.key)
+            if expires_at is not None and expires_at > now:
+                expires = time.time() + (expires_at - now).total_seconds()
+                deadline = expires if deadline is None else min(deadline, expires)
+
+        self._deadline = deadline
+        self._epoch = epoch
+
+    def set(self, name, value):
+        """
+        Update an option by attribute name, with its autoload and ttl.
+
+        Raises ValueError if the value can't be converted to the type of the option.
+        """
+        field = self.fields[name]
+        return self._manager.update_option(field.key, field.clean(value), autoload=field.autoload, ttl=field.ttl)
+
+    def install(self):
+        """
+        Add missing options with their default values.
+
+        :return dict True by key of added options.
+        """
+        batches = {}
+        for field in self.fields.values():
+            if field.default is not None:
+                batches.setdefault((field.autoload, field.ttl), {})[field.key] = field.default
+
+        added = {}
+        for (autoload, ttl), options in batches.items():
+            added.update(self._manager.add_options(options, autoload=autoload, ttl=ttl))
+        return added
+
+    def as_dict(self):
+        return dict((attr, getattr(self, attr)) for attr in self.fields)
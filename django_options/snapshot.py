@@ -0,0 +1,155 @@
+"""
+Request-scoped view of options.
+
+While a snapshot is active in a thread, every read of OptionManager is
+memoized, so a request sees the same value of an option from start to end,
+and every write is buffered until the snapshot ends, when all writes are
+flushed with a few bulk queries. Writes are dropped if the block raises.
+
+    with Option.objects.snapshot():
+        ...
+
+OptionsLoaderMiddleware takes a snapshot for each request with
+``OPTIONS_REQUEST_SNAPSHOT = True``.
+"""
+
+# memoized value of not existing options
+_absent = object()
+
+
+class OptionSnapshot(object):
+
+    def __init__(self, manager):
+        self.manager = manager
+        self.values = {}
+        # buffered writes by key, as ('add' or 'update', value, kwargs) or ('delete',)
+        self.writes = {}
+        # keys added in this snapshot, a delete cancels them
+        self.created = set()
+
+    def __enter__(self):
+        self.manager.begin_snapshot(self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        # writes of a failed block are dropped
+        self.manager.end_snapshot(discard=exc_type is not None)
+
+    def get_option(self, key, default=None):
+        key = key.strip()
+        if not key: return None
+
+        value = self.values.get(key, _absent)
+        if value is _absent:
+            if key in self.values:
+                return default
+            value = self.manager.read_option(key, _absent)
+            self.values[key] = value
+            if value is _absent:
+                return default
+        return value
+
+    def get_options(self, keys, defaults=None):
+        keys = list(keys)
+        if not isinstance(defaults, dict):
+            defaults = dict.fromkeys(keys, defaults)
+
+        missing = [key for key in keys if key.strip() not in self.values]
+        if missing:
+            for name, value in self.manager.read_options(missing, _absent).items():
+                self.values[name.strip()] = value
+
+        values = {}
+        for name in keys:
+            key = name.strip()
+            if not key: continue
+            value = self.values[key]
+            values[name] = defaults.get(name) if value is _absent else value
+        return values
+
+    def update_option(self, key, new_value, **kwargs):
+        key = key.strip()
+        if not key: return None
+
+        new_value = self.manager.copy_value(new_value)
+        old_value = self.get_option(key)
+        if new_value == old_value and (old_value is None or not kwargs.get('ttl') and not kwargs.get('expires_at')):
+            return False
+
+        if old_value is None:
+            return self.add_option(key, new_value, **kwargs)
+
+        if key in self.created:
+            # still to add, with its arguments
+            action, value, add_kwargs = self.writes[key]
+            for name in ('ttl', 'expires_at'):
+                if kwargs.get(name) is not None:
+                    add_kwargs[name] = kwargs[name]
+            self.writes[key] = ('add', new_value, add_kwargs)
+        else:
+            self.writes[key] = ('update', new_value, kwargs)
+        self.values[key] = new_value
+        return True
+
+    def add_option(self, key, value, autoload=True, ttl=None, expires_at=None):
+        key = key.strip()
+        if not key: return None
+
+        if self.get_option(key) is not None:
+            return False
+
+        value = self.manager.copy_value(value)
+        kwargs = {'autoload': autoload, 'ttl': ttl, 'expires_at': expires_at}
+        if self.writes.get(key, ('add',))[0] == 'delete':
+            # deleted in this snapshot, the row still exists
+            self.writes[key] = ('update', value, kwargs)
+        else:
+            self.writes[key] = ('add', value, kwargs)
+            self.created.add(key)
+        self.values[key] = value
+        return True
+
+    def delete_option(self, key):
+        key = key.strip()
+        if not key: return None
+
+        if self.get_option(key) is None:
+            return False
+
+        if key in self.created:
+            # never written
+            self.created.discard(key)
+            del self.writes[key]
+        else:
+            self.writes[key] = ('delete',)
+        self.values[key] = _absent
+        return True
+
+    def update_options(self, options, **kwargs):
+        return dict((key, self.update_option(key, value, **kwargs)) for key, value in options.items())
+
+    def add_options(self, options, **kwargs):
+        return dict((key, self.add_option(key, value, **kwargs)) for key, value in options.items())
+
+    def flush(self):
+        """
+        Write buffered changes, with a bulk write for all options
+        written with same arguments.
+        """
+        batches = {}
+        for key, write in self.writes.items():
+            if write[0] == 'delete':
+                self.manager.delete_option(key)
+                continue
+            action, value, kwargs = write
+            batch = (action, tuple(sorted(kwargs.items())))
+            batches.setdefault(batch, {})[key] = value
+
+        for (action, kwargs), values in batches.items():
+            if action == 'add':
+                self.manager.add_options(values, **dict(kwargs))
+            else:
+                self.manager.update_options(values, **dict(kwargs))
+
+        self.writes = {}
+        self.created = set()
@@ -1,10 +1,51 @@
 from inspect import getargspec
+from django.core.cache import cache
 from django.template import Library, base
-from .. import get_option
+from .. import get_option, options_cache_key
+from ..models import Option
 
 register = Library()
 
-def optional_assignment_tag(func=None, takes_context=None, name=None):
+
+class AssignmentNode(base.TagHelperNode):
+    def __init__(self, func, takes_context, args, kwargs, target_var=None):
+        super(AssignmentNode, self).__init__(takes_context, args, kwargs)
+        self.func = func
+        self.target_var = target_var
+
+    def render(self, context):
+        output = self.get_output(context)
+        if self.target_var is None:
+            return output
+        else:
+            context[self.target_var] = output
+        return ''
+
+    def get_output(self, context):
+        resolved_args, resolved_kwargs = self.get_resolved_arguments(context)
+        return self.func(*resolved_args, **resolved_kwargs)
+
+
+class OptionNode(AssignmentNode):
+    """
+    Node of the option tag, an option with a literal key is bound to its
+    handle when the template is compiled.
+    """
+    def __init__(self, func, takes_context, args, kwargs, target_var=None):
+        super(OptionNode, self).__init__(func, takes_context, args, kwargs, target_var)
+        self.handle = None
+        if args and isinstance(args[0].var, basestring) and not args[0].filters:
+            self.handle = Option.objects.handle(args[0].var)
+            self.default = args[1] if len(args) > 1 else kwargs.get('default')
+
+    def get_output(self, context):
+        if self.handle is None:
+            return super(OptionNode, self).get_output(context)
+        default = self.default
+        return self.handle.get(None if default is None else default.resolve(context))
+
+
+def optional_assignment_tag(func=None, takes_context=None, name=None, node_class=AssignmentNode):
     """
     https://groups.google.com/forum/?fromgroups=#!topic/django-developers/E0XWFrkRMGc
     new template tags type
@@ -12,20 +53,6 @@ def optional_assignment_tag(func=None, takes_context=None, name=None):
     def dec(func):
         params, varargs, varkw, defaults = getargspec(func)
 
-        class AssignmentNode(base.TagHelperNode):
-            def __init__(self, takes_context, args, kwargs, target_var=None):
-                super(AssignmentNode, self).__init__(takes_context, args, kwargs)
-                self.target_var = target_var
-
-            def render(self, context):
-                resolved_args, resolved_kwargs = self.get_resolved_arguments(context)
-                output = func(*resolved_args, **resolved_kwargs)
-                if self.target_var is None:
-                    return output
-                else:
-                    context[self.target_var] = output
-                return ''
-
         function_name = (name or
                          getattr(func, '_decorated_function', func).__name__)
 
@@ -38,7 +65,7 @@ def optional_assignment_tag(func=None, takes_context=None, name=None):
                 bits = bits[:-2]
             args, kwargs = base.parse_bits(parser, bits, params,
                 varargs, varkw, defaults, takes_context, function_name)
-            return AssignmentNode(takes_context, args, kwargs, target_var)
+            return node_class(func, takes_context, args, kwargs, target_var)
 
         compile_func.__doc__ = func.__doc__
         register.tag(function_name, compile_func)
@@ -52,7 +79,7 @@ def optional_assignment_tag(func=None, takes_context=None, name=None):
     else:
         raise base.TemplateSyntaxError("Invalid arguments provided to assignment_tag")
 
-@optional_assignment_tag(name='option')
+@optional_assignment_tag(name='option', node_class=OptionNode)
 def do_get_option( option_name, default=None ):
     """
     retrieve a option value by key
@@ -65,6 +92,9 @@ def do_get_option( option_name, default=None ):
         {% option "optionName" %}
         {% option "optionName" "not found" %}
 
+    A quoted option name is bound to the option when the template is
+    compiled, then rendering it doesn't look up caches again while
+    options don't change.
     """
     return get_option(option_name, default=default )
 
@@ -81,7 +111,7 @@ def do_get_option_filter( option_name, default=None ):
         {% for element in 'option_name'|option:var_with_list %}{{ element }}\n{% endfor %}
 
     """
-    return get_option( option_name, default=default )
+    return Option.objects.handle( option_name ).get( default )
 
 
 @register.filter(name='or_option')
@@ -94,6 +124,57 @@ def do_or_option_filter( value, option_name ):
 
     """
     if not value:
-        value = get_option(option_name)
+        value = Option.objects.handle(option_name).get()
     return value
 
+
+class CacheWithOptionsNode(base.Node):
+    def __init__(self, nodelist, expire_time, fragment_name, keys, vary_on):
+        self.nodelist = nodelist
+        self.expire_time = expire_time
+        self.fragment_name = fragment_name
+        self.keys = keys
+        self.vary_on = vary_on
+        # prefetched by the template loader
+        self.option_keys = [key.var for key in keys if isinstance(key.var, basestring) and not key.filters]
+
+    def render(self, context):
+        try:
+            expire_time = int(self.expire_time.resolve(context))
+        except (ValueError, TypeError):
+            raise base.TemplateSyntaxError('"cache_with_options" tag got a non-integer timeout value: %r' % self.expire_time.token)
+        keys = [key.resolve(context) for key in self.keys]
+        cache_key = options_cache_key(self.fragment_name, keys, [var.resolve(context) for var in self.vary_on])
+        value = cache.get(cache_key)
+        if value is None:
+            value = self.nodelist.render(context)
+            cache.set(cache_key, value, expire_time)
+        return value
+
+
+@register.tag('cache_with_options')
+def do_cache_with_options(parser, token):
+    """
+    cache a fragment until the options it depends on change, as the cache tag
+    uses:
+
+        {% cache_with_options 3600 sidebar "site_title" "menu" %}
+            .. uses options site_title and menu ..
+        {% endcache_with_options %}
+
+        {% cache_with_options 3600 sidebar "site_title" vary_on request.user.pk %}
+            ..
+        {% endcache_with_options %}
+
+    """
+    nodelist = parser.parse(('endcache_with_options',))
+    parser.delete_first_token()
+    bits = token.split_contents()
+    if len(bits) < 4:
+        raise base.TemplateSyntaxError(u"%r tag requires at least 3 arguments." % bits[0])
+    keys, vary_on = bits[3:], []
+    if 'vary_on' in keys:
+        position = keys.index('vary_on')
+        keys, vary_on = keys[:position], keys[position + 1:]
+    return CacheWithOptionsNode(nodelist, parser.compile_filter(bits[1]), bits[2],
+        [parser.compile_filter(key) for key in keys], [parser.compile_filter(var) for var in vary_on])
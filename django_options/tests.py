@@ -1,19 +1,88 @@
 
 #from django.utils.unittest import TestCase
 
+import os
+import copy
+import pickle
+import re
+import shutil
+import time
+import tempfile
+import threading
+from datetime import timedelta
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
+from django.db import connection
+from django.http import HttpResponse
+from django.template import Template, Context, loader
+from django.test.client import RequestFactory
+from django.test.utils import override_settings
+try:
+    from django.test.utils import CaptureQueriesContext
+except ImportError:
+    # django < 1.6
+    CaptureQueriesContext = None
 from django.test import TestCase
-from .models import Option
+from django.utils import timezone
+from .models import Option, OptionGeneration
+from .managers import Flight, LazyValue, NOT_CACHED
+from .signals import option_value_changed
+from .utils.lru import LRUCache
+from .utils.frozen import freeze, thaw, FrozenDict, FrozenList
+from .invalidation import FileInvalidationBackend, DatabaseInvalidationBackend
+from .cache import get_shared_cache
+from .schema import OptionSchema, OptionField
+from .codec import get_codec
+from .metrics import OptionMetrics
+from .loaders import template_option_keys
+from .api import options_version, options_cache_key
+from .decorators import condition_on_options
+from .context_processors import OptionsProxy, options as options_processor
 
-class OptionManagerTestCase(TestCase):
+# statements reading or writing rows, as logged by any version of django
+# (sqlite logs "QUERY = u'...' - PARAMS = ..." on django 1.6)
+DATA_QUERY = re.compile(r"""(?:QUERY = u?['"])?\s*(SELECT|INSERT|UPDATE|DELETE)\b""", re.I)
+
+
+class OptionTestCase(TestCase):
+    """
+    Runs each test with empty caches and no options on any site, and
+    restores what use_settings and patch change when it ends.
+    """
 
     def setUp(self):
         self.o = Option.objects
         self.o.clear()
         # delete all from all sites
         Option.all.all().delete()
+        # cleanups run last to first, so caches are cleared after all restores
+        self.addCleanup(self.o.clear)
+
+    def use_settings(self, **kwargs):
+        """
+        Override settings until the end of the test.
+        """
+        overridden = override_settings(**kwargs)
+        overridden.enable()
+        self.addCleanup(overridden.disable)
+
+    def patch(self, obj, **attrs):
+        """
+        Set attributes of obj, as a manager, until the end of the test.
+        """
+        for name, value in attrs.items():
+            if name in obj.__dict__:
+                self.addCleanup(setattr, obj, name, obj.__dict__[name])
+            else:
+                # defined by the class, as methods
+                self.addCleanup(delattr, obj, name)
+            setattr(obj, name, value)
+
+
+class OptionManagerTestCase(OptionTestCase):
 
     def test_adding_options(self):
-        with self.assertNumQueries(2):
+        with self.assertNumQueries(1):
             self.assertEqual( self.o.fetch_all_options(), {} )
         with self.assertNumQueries(0):
             self.assertEqual( self.o.fetch_all_options(), {} )
@@ -25,7 +94,7 @@ class OptionManagerTestCase(TestCase):
     #        value_types = [0,1,None,False,[],{},[1,2,3],{'a':1,'b':2},datetime(2012,11,1,23,30,15),{'float':2.15,'subdict':{'date': datetime(2012,11,1,23,30,15)}}]
         value_types = [0,1,None,False,[],{},[1,2,3],{'a':1,'b':2}]
 
-        with self.assertNumQueries( len(value_types)*2 + 2 ) :
+        with self.assertNumQueries( len(value_types)*2 + 1 ) :
             # add options
             for i, obj in enumerate(value_types):
                 self.assertTrue( self.o.add_option("key_%s" % i, obj) )
@@ -70,6 +139,65 @@ class OptionManagerTestCase(TestCase):
         self.assertNotIn('oof',self.o.all_options)
         self.assertIn('oof',self.o.single_options)
 
+    def test_update_options(self):
+        """Testing update_options to write several options at once"""
+        self.assertTrue(self.o.add_option('one', 1))
+        self.assertTrue(self.o.add_option('two', 2))
+        self.assertTrue(self.o.add_option('three', 3))
+
+        changes = []
+        def collect(sender, **kwargs):
+            changes.append((kwargs['option'], kwargs['old_value'], kwargs['new_value']))
+        option_value_changed.connect(collect)
+        try:
+            # one insert and one update for each distinct value, after reading missing ones
+            results, queries = self.count_data_queries(
+                self.o.update_options, {'one': 1, 'two': True, 'three': True, 'four': 4, 'five': 5})
+            self.assertEqual(queries, 3)
+        finally:
+            option_value_changed.disconnect(collect)
+
+        self.assertEqual(results, {'one': False, 'two': True, 'three': True, 'four': True, 'five': True})
+        self.assertEqual(sorted(changes), [('five', None, 5), ('four', None, 4), ('three', 3, True), ('two', 2, True)])
+
+        self.o.clear()
+        self.assertEqual(self.o.get_options(['one', 'two', 'three', 'four', 'five']),
+                         {'one': 1, 'two': True, 'three': True, 'four': 4, 'five': 5})
+
+        # only missing options are added
+        self.assertEqual(self.o.add_options({'one': 0, 'six': 6}), {'one': False, 'six': True})
+        self.assertEqual(self.o.get_option('one'), 1)
+        self.assertEqual(self.o.get_option('six'), 6)
+
+    def test_update_options_with_none_values(self):
+        self.assertTrue(self.o.add_option('a', None))
+        self.assertTrue(self.o.add_option('b', 1))
+        self.o.clear()
+        self.assertEqual(self.o.update_options({'a': 5, 'b': 2}), {'a': True, 'b': True})
+        self.assertEqual(self.o.add_options({'a': 6}), {'a': False})
+        self.o.clear()
+        self.assertEqual(self.o.get_options(['a', 'b']), {'a': 5, 'b': 2})
+
+    def count_data_queries(self, func, *args):
+        """
+        Result of func and number of its queries, without the transaction
+        statements that depend on the version of django.
+        """
+        if CaptureQueriesContext is not None:
+            with CaptureQueriesContext(connection) as context:
+                result = func(*args)
+            queries = context.captured_queries
+        else:
+            old_debug = connection.use_debug_cursor
+            connection.use_debug_cursor = True
+            start = len(connection.queries)
+            try:
+                result = func(*args)
+            finally:
+                connection.use_debug_cursor = old_debug
+            queries = connection.queries[start:]
+        return result, len([query for query in queries if DATA_QUERY.match(query['sql'])])
+
     def test_option_deleting(self):
         """Testing delete_option"""
         self.assertTrue(self.o.add_option('foo','bar'))
@@ -96,11 +224,48 @@ class OptionManagerTestCase(TestCase):
         self.assertIn( 'two', all_options )
         self.assertNotIn( 'three', all_options )
 
+    def test_loader_policies(self):
+        """Options loaded by fetch_all_options"""
+        self.assertTrue( self.o.add_option('one', 1, autoload=False) )
+        self.assertTrue( self.o.add_option('two', 2, autoload=False) )
+
+        # only autoloaded options, by default
+        self.o.clear()
+        with self.assertNumQueries(1):
+            self.assertEqual( self.o.fetch_all_options(), {} )
+
+        # no autoloaded options, fallback on all with a second query
+        self.patch(self.o, loader='fallback')
+        self.o.clear()
+        with self.assertNumQueries(2):
+            self.assertEqual( sorted(self.o.fetch_all_options()), ['one', 'two'] )
+
+        # capped by the limit
+        self.patch(self.o, loader_limit=1)
+        self.o.clear()
+        self.assertEqual( len(self.o.fetch_all_options()), 1 )
+        self.patch(self.o, loader_limit=None)
+
+        # other options are not read at all
+        self.assertTrue( self.o.add_option('three', 3, autoload=True) )
+        self.o.clear()
+        with self.assertNumQueries(1):
+            self.assertEqual( sorted(self.o.fetch_all_options()), ['three'] )
+
+        self.patch(self.o, loader='all')
+        self.o.clear()
+        self.assertEqual( sorted(self.o.fetch_all_options()), ['one', 'three', 'two'] )
+
+        # autoloaded first
+        self.patch(self.o, loader_limit=2)
+        self.o.clear()
+        self.assertEqual( len(self.o.fetch_all_options()), 2 )
+        self.assertIn( 'three', self.o.all_options )
+
     def test_option_cache(self):
         """ Testing the integration between cache and options"""
-        with self.assertNumQueries(2):
-            # two because there's not autoloaded options
-            # then fetch all
+        with self.assertNumQueries(1):
+            # autoloaded options only, even if there are none
             self.o.fetch_all_options()
 
         with self.assertNumQueries(0):
@@ -131,7 +296,7 @@ class OptionManagerTestCase(TestCase):
         self.o.clear()
         self.assertEqual(Option.all.count(), 0)
 
-        with self.assertNumQueries(     4     ):
+        with self.assertNumQueries(     3     ):
             self.assertTrue( self.o.add_option('key', 'value') )
 
         # clearing for repeat with new autoloads
@@ -140,7 +305,7 @@ class OptionManagerTestCase(TestCase):
         self.assertEqual(Option.all.count(), 0)
         k = 100
         #                               DOUBLE (check if exists)
-        with self.assertNumQueries(     (k*2) +2     ):
+        with self.assertNumQueries(     (k*2) +1     ):
             for i in range(0,k):
                 self.assertTrue( self.o.add_option('key_%s' % i, k) )
 
@@ -252,11 +417,1297 @@ class OptionManagerTestCase(TestCase):
         self.assertTrue(API.add_option('link',1))
         self.assertEqual(API.symbolic_option('key'), 1)
 
+        self.assertEqual(API.get_options(['foo', 'link', 'bar'], {'bar': 0}), {'foo': 'bar', 'link': 1, 'bar': 0})
+
+    def test_get_options(self):
+        """Testing get_options to retrieve several options with a single query"""
+        self.assertTrue(self.o.add_option('one', 1))
+        for i in range(5):
+            self.assertTrue(self.o.add_option('key_%s' % i, i, autoload=False))
+        self.o.clear()
+        self.o.fetch_all_options()
+
+        keys = ['one', 'missing'] + ['key_%s' % i for i in range(5)]
+        with self.assertNumQueries(1):
+            options = self.o.get_options(keys, 'default')
+        self.assertEqual(options['one'], 1)
+        self.assertEqual(options['missing'], 'default')
+        for i in range(5):
+            self.assertEqual(options['key_%s' % i], i)
+
+        # all cached
+        self.assertIn('missing', self.o.not_options)
+        self.assertIn('key_0', self.o.single_options)
+        with self.assertNumQueries(0):
+            self.assertEqual(self.o.get_options(keys, {'missing': 2})['missing'], 2)
+            self.assertEqual(self.o.get_option('key_4'), 4)
+
+        # any iterable, and names of the same option
+        self.o.clear()
+        self.o.fetch_all_options()
+        with self.assertNumQueries(1):
+            self.assertEqual(self.o.get_options(key for key in ['one', 'key_0', ' key_0 ']),
+                             {'one': 1, 'key_0': 0, ' key_0 ': 0})
+        with self.o.snapshot():
+            self.assertEqual(self.o.get_options(iter(['key_1', 'key_1 '])), {'key_1': 1, 'key_1 ': 1})
+
+
+    def test_peek_option(self):
+        self.assertTrue(self.o.add_option('one', 1))
+        self.assertTrue(self.o.add_option('lazy', 2, autoload=False))
+        self.o.clear()
+        with self.assertNumQueries(0):
+            self.assertIs(self.o.peek_option('one'), NOT_CACHED)
+        self.o.fetch_all_options()
+        with self.assertNumQueries(0):
+            self.assertEqual(self.o.peek_option('one'), 1)
+            self.assertIs(self.o.peek_option('lazy'), NOT_CACHED)
+            self.assertIs(self.o.peek_option('missing'), NOT_CACHED)
+        self.assertEqual(self.o.get_option('lazy'), 2)
+        self.assertIsNone(self.o.get_option('missing'))
+        with self.assertNumQueries(0):
+            self.assertEqual(self.o.peek_option('lazy'), 2)
+            self.assertEqual(self.o.peek_option('missing', 'default'), 'default')
+
+
+class OptionInvalidationTestCase(OptionTestCase):
+
+    def setUp(self):
+        super(OptionInvalidationTestCase, self).setUp()
+        fd, self.path = tempfile.mkstemp()
+        os.close(fd)
+        self.addCleanup(os.remove, self.path)
+        self.patch(self.o, invalidation=FileInvalidationBackend(path=self.path), invalidation_interval=0, next_sync=0)
+        # another process that shares the same file
+        self.other = FileInvalidationBackend(path=self.path)
+
+    def test_writes_are_published(self):
+        site_id = self.o.get_site_id()
+        self.assertTrue(self.o.add_option('foo', 'bar'))
+        self.assertTrue(self.o.update_option('foo', 'rab'))
+        self.assertTrue(self.o.delete_option('foo'))
+        self.assertEqual(self.other.poll(site_id), set(['foo']))
+        # nothing new
+        self.assertEqual(self.other.poll(site_id), ())
+        # own changes are ignored
+        self.assertEqual(self.o.invalidation.poll(site_id), set())
+
+    def test_default_path_is_per_project(self):
+        path = FileInvalidationBackend.default_path()
+        self.assertEqual(os.path.dirname(path), tempfile.gettempdir())
+        self.assertEqual(FileInvalidationBackend.default_path(), path)
+        with override_settings(SETTINGS_MODULE='other_project.settings'):
+            self.assertNotEqual(FileInvalidationBackend.default_path(), path)
+
+    def test_writes_before_sync_are_published(self):
+        manager = Option.objects.__class__()
+        manager.model = Option
+        with override_settings(OPTIONS_INVALIDATION_BACKEND='django_options.invalidation.FileInvalidationBackend',
+                               OPTIONS_INVALIDATION_BACKEND_OPTIONS={'path': self.path}):
+            Option.all.create(site_id=self.o.get_site_id(), key='foo', value='bar')
+            # deleting doesn't read, nor sync
+            self.assertTrue(manager.delete_option('foo'))
+        self.assertIsNotNone(manager.invalidation)
+        self.assertEqual(self.other.poll(self.o.get_site_id()), set(['foo']))
+
+    def test_changed_keys_are_dropped(self):
+        self.assertTrue(self.o.add_option('foo', 'bar'))
+        self.assertTrue(self.o.add_option('oof', 'rab', autoload=False))
+        self.assertIsNone(self.o.get_option('missing'))
+        self.assertIn('missing', self.o.not_options)
+
+        # another process changes the database
+        Option.all.filter(key='foo').update(value='changed')
+        self.other.publish(self.o.get_site_id(), ['foo', 'missing'])
+
+        with self.assertNumQueries(2):
+            self.assertEqual(self.o.get_option('foo'), 'changed')
+            self.assertIsNone(self.o.get_option('missing'))
+            # untouched keys are still cached
+            self.assertEqual(self.o.get_option('oof'), 'rab')
+
+    def test_rotation_drops_all_caches(self):
+        self.assertTrue(self.o.add_option('foo', 'bar'))
+        self.o.invalidation.max_bytes = 0
+        self.other.max_bytes = 0
+        self.other.publish(self.o.get_site_id(), ['other'])
+        self.o.sync()
+        self.assertIsNone(self.o.all_options)
+
+
+class OptionGenerationTestCase(OptionTestCase):
+
+    def setUp(self):
+        super(OptionGenerationTestCase, self).setUp()
+        self.patch(self.o, invalidation=DatabaseInvalidationBackend(), invalidation_interval=None, next_sync=0)
+        self.other = DatabaseInvalidationBackend()
+        self.site_id = self.o.get_site_id()
+
+    def test_generation_delta(self):
+        with self.assertNumQueries(1):
+            self.assertEqual(self.other.poll(self.site_id), ())
+        self.assertTrue(self.o.add_option('foo', 'bar'))
+        self.assertTrue(self.o.add_option('oof', 'rab'))
+        self.assertTrue(self.o.update_option('foo', 'baz'))
+        with self.assertNumQueries(1):
+            self.assertEqual(self.other.poll(self.site_id), set(['foo', 'oof']))
+        with self.assertNumQueries(1):
+            self.assertEqual(self.other.poll(self.site_id), set())
+
+    def test_generation_committed_out_of_order(self):
+        self.assertEqual(self.other.poll(self.site_id), ())
+        self.o.invalidation.publish(self.site_id, ['foo'])
+        self.o.invalidation.publish(self.site_id, ['oof'])
+        first, second = OptionGeneration.objects.order_by('pk')
+        # the first change is not committed yet
+        generation = first.pk
+        first.delete()
+        with self.assertNumQueries(1):
+            self.assertEqual(self.other.poll(self.site_id), set(['oof']))
+        first.pk = generation
+        first.save()
+        with self.assertNumQueries(1):
+            self.assertEqual(self.other.poll(self.site_id), set(['foo']))
+        with self.assertNumQueries(1):
+            self.assertEqual(self.other.poll(self.site_id), set())
+
+        # rolled back changes are not polled again after overlap seconds
+        self.other.overlap = 0
+        self.o.invalidation.publish(self.site_id, ['foo', 'oof'])
+        OptionGeneration.objects.filter(key='foo').order_by('-pk')[0].delete()
+        self.assertEqual(self.other.poll(self.site_id), set(['oof']))
+        self.assertEqual(len(self.other.gaps), 1)
+        self.other.gaps = dict.fromkeys(self.other.gaps, time.time() - 1)
+        self.assertEqual(self.other.poll(self.site_id), set())
+        self.assertEqual(self.other.gaps, {})
+
+    def test_sync_reloads_only_delta(self):
+        self.o.sync(force=True)
+        self.assertTrue(self.o.add_option('foo', 'bar'))
+        self.assertTrue(self.o.add_option('oof', 'rab'))
+
+        # another process changes an option
+        self.other.poll(self.site_id)
+        Option.all.filter(key='foo').update(value='changed')
+        self.other.publish(self.site_id, ['foo'])
+
+        # checked only when forced, as OptionsLoaderMiddleware does
+        with self.assertNumQueries(0):
+            self.assertEqual(self.o.get_option('foo'), 'bar')
+        with self.assertNumQueries(2):
+            self.o.sync(force=True)
+        with self.assertNumQueries(0):
+            self.assertEqual(self.o.get_option('foo'), 'changed')
+            self.assertEqual(self.o.get_option('oof'), 'rab')
+
+
+class OptionExpiryTestCase(OptionTestCase):
+
+    def expire(self, key):
+        Option.all.filter(key=key).update(expires_at=timezone.now() - timedelta(seconds=1))
+
+    def test_expired_options_are_not_served(self):
+        self.assertTrue(self.o.add_option('flag', 'on', ttl=60))
+        self.assertTrue(self.o.add_option('promo', 'on', autoload=False, ttl=60))
+        self.assertTrue(self.o.add_option('forever', 'on'))
+        self.assertEqual(self.o.get_option('flag'), 'on')
+        self.assertEqual(self.o.get_option('promo'), 'on')
+
+        # expires in cached values
+        self.o.expires['flag'] = timezone.now() - timedelta(seconds=1)
+        with self.assertNumQueries(0):
+            self.assertEqual(self.o.get_option('flag', 'off'), 'off')
+            self.assertEqual(self.o.get_option('forever'), 'on')
+        self.assertIn('flag', self.o.not_options)
+
+        # expired rows are not loaded
+        self.expire('flag')
+        self.expire('promo')
+        self.o.clear()
+        self.assertNotIn('flag', self.o.fetch_all_options())
+        self.assertIsNone(self.o.get_option('promo'))
+        self.assertEqual(self.o.get_option('forever'), 'on')
+
+    def test_expired_options_can_be_added_again(self):
+        self.assertTrue(self.o.add_option('flag', 'on', ttl=60))
+        self.expire('flag')
+        self.o.clear()
+        self.assertTrue(self.o.update_option('flag', 'again'))
+        self.assertEqual(self.o.get_option('flag'), 'again')
+        self.assertEqual(Option.all.get(key='flag').expires_at, None)
+
+    def test_update_ttl(self):
+        self.assertTrue(self.o.add_option('flag', 'on'))
+        self.assertTrue(self.o.update_option('flag', 'on', ttl=60))
+        self.assertIsNotNone(Option.all.get(key='flag').expires_at)
+        self.assertIn('flag', self.o.expires)
+
+    def test_delete_expired_options(self):
+        import django_options.api as API
+        for i in range(5):
+            self.assertTrue(self.o.add_option('flag_%s' % i, i, ttl=60))
+            self.expire('flag_%s' % i)
+        self.assertTrue(self.o.add_option('forever', 'on'))
+
+        # of all sites
+        from django.contrib.sites.models import Site
+        other = self.o.for_site(Site.objects.create(domain='other.example.com', name='other').pk)
+        self.assertTrue(other.add_option('flag', 'on', ttl=60))
+        Option.all.filter(site=other.site_id).update(expires_at=timezone.now() - timedelta(seconds=1))
+
+        self.assertEqual(API.delete_expired_options(batch_size=2), 6)
+        self.assertEqual(list(Option.all.values_list('key', flat=True)), ['forever'])
+        self.assertIsNone(self.o.get_option('flag_0'))
+        self.assertIsNone(other.get_option('flag'))
+        self.o.sites.clear()
+
+
+class OptionCacheBoundsTestCase(OptionTestCase):
+
+    def setUp(self):
+        super(OptionCacheBoundsTestCase, self).setUp()
+        self.patch(self.o, cache_size=3, negative_cache_size=3)
+        self.o.clear()
+
+    def test_lru_cache(self):
+        cache = LRUCache(2)
+        cache['a'] = 1
+        cache['b'] = 2
+        self.assertEqual(cache.get('a'), 1)
+        cache['c'] = 3
+        # b is the least recently used
+        self.assertNotIn('b', cache)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.stats(), {'size': 2, 'capacity': 2, 'hits': 1, 'misses': 1, 'evictions': 1})
+
+    def test_lru_cache_churn(self):
+        cache = LRUCache(2)
+        # keys inserted again after being dropped, as by forget
+        for key in ('a', 'b'):
+            for i in range(6):
+                cache[key] = i
+                if i < 5:
+                    cache.pop(key)
+        self.assertEqual(sorted(cache.keys()), ['a', 'b'])
+        for i in range(10):
+            cache['new%d' % i] = i
+            self.assertTrue(len(cache) <= 2)
+        self.assertIn('new9', cache)
+        self.assertTrue(len(cache.order) <= 5)
+
+    def test_lru_cache_without_capacity(self):
+        cache = LRUCache(0)
+        cache['a'] = 1
+        self.assertNotIn('a', cache)
+        self.assertIsNone(cache.get('a'))
+
+    def test_negative_cache_is_bounded(self):
+        for i in range(10):
+            self.assertIsNone(self.o.get_option('probe_%s' % i))
+        self.assertEqual(len(self.o.not_options), 3)
+        self.assertIn('probe_9', self.o.not_options)
+        self.assertNotIn('probe_0', self.o.not_options)
+        self.assertEqual(self.o.cache_stats()['not_options']['evictions'], 7)
+
+    def test_negative_cache_counts_only_negative_lookups(self):
+        self.assertTrue(self.o.add_option('one', 1))
+        self.assertIsNone(self.o.get_option('missing'))
+        before = self.o.cache_stats()['not_options']
+        for i in range(5):
+            self.assertEqual(self.o.get_option('one'), 1)
+        self.assertIsNone(self.o.get_option('missing'))
+        after = self.o.cache_stats()['not_options']
+        self.assertEqual((after['hits'], after['misses']), (before['hits'] + 1, before['misses']))
+
+    def test_single_cache_is_bounded(self):
+        for i in range(5):
+            self.assertTrue(self.o.add_option('key_%s' % i, i, autoload=False))
+        self.assertEqual(len(self.o.single_options), 3)
+        # evicted keys are fetched again
+        with self.assertNumQueries(1):
+            self.assertEqual(self.o.get_option('key_0'), 0)
+        with self.assertNumQueries(0):
+            self.assertEqual(self.o.get_option('key_0'), 0)
+
+
+class OptionSharedCacheTestCase(OptionTestCase):
+
+    def setUp(self):
+        super(OptionSharedCacheTestCase, self).setUp()
+        self.patch(self.o, shared_cache=get_shared_cache('default'))
+        self.o.shared_cache.cache.clear()
+        self.addCleanup(self.o.shared_cache.cache.clear)
+
+    def test_snapshot(self):
+        self.assertTrue(self.o.add_option('one', 1))
+        self.assertTrue(self.o.add_option('two', 2))
+
+        # the first process loads the database
+        self.o.clear()
+        with self.assertNumQueries(1):
+            self.assertEqual(self.o.get_option('one'), 1)
+
+        # then others load the snapshot
+        self.o.clear()
+        with self.assertNumQueries(0):
+            self.assertEqual(self.o.get_option('one'), 1)
+            self.assertEqual(self.o.get_option('two'), 2)
+
+        # a write invalidates the snapshot
+        self.assertTrue(self.o.update_option('two', 3))
+        self.o.clear()
+        with self.assertNumQueries(1):
+            self.assertEqual(self.o.get_option('two'), 3)
+
+    def test_single_options(self):
+        self.assertTrue(self.o.add_option('one', 1))
+        self.assertTrue(self.o.add_option('two', 2, autoload=False))
+        self.o.clear()
+        self.assertEqual(self.o.get_options(['two', 'missing']), {'two': 2, 'missing': None})
+
+        self.o.clear()
+        with self.assertNumQueries(0):
+            self.assertEqual(self.o.get_option('two'), 2)
+            self.assertIsNone(self.o.get_option('missing'))
+
+        # written through
+        self.assertTrue(self.o.update_option('two', 3))
+        self.assertTrue(self.o.add_option('missing', 'found', autoload=False))
+        self.o.clear()
+        self.o.fetch_all_options()
+        with self.assertNumQueries(0):
+            self.assertEqual(self.o.get_option('two'), 3)
+            self.assertEqual(self.o.get_option('missing'), 'found')
+
+
+class OptionSnapshotTestCase(OptionTestCase):
+
+    def setUp(self):
+        super(OptionSnapshotTestCase, self).setUp()
+        self.assertTrue(self.o.add_option('one', 1))
+        self.assertTrue(self.o.add_option('two', 2))
+
+    def tearDown(self):
+        self.o.end_snapshot()
+
+    def test_repeatable_reads(self):
+        with self.o.snapshot():
+            self.assertEqual(self.o.get_option('one'), 1)
+            # changed by another thread
+            self.o.single_options['one'] = 'changed'
+            self.assertEqual(self.o.get_option('one'), 1)
+            self.assertEqual(self.o.get_options(['one', 'two', 'three'], 0), {'one': 1, 'two': 2, 'three': 0})
+        self.assertEqual(self.o.get_option('one'), 'changed')
+
+    def test_buffered_writes(self):
+        with self.o.snapshot():
+            # only lookups of three and four
+            with self.assertNumQueries(2):
+                self.assertTrue(self.o.update_option('one', 'one'))
+                self.assertTrue(self.o.update_option('two', 'two'))
+                self.assertTrue(self.o.add_option('three', 3))
+                self.assertFalse(self.o.add_option('three', 3))
+                self.assertTrue(self.o.add_option('four', 4))
+                self.assertTrue(self.o.delete_option('four'))
+                # reads see writes
+                self.assertEqual(self.o.get_option('one'), 'one')
+                self.assertIsNone(self.o.get_option('four'))
+            self.assertEqual(Option.all.get(key='one').value, 1)
+
+        self.assertEqual(Option.all.get(key='one').value, 'one')
+        self.o.clear()
+        self.assertEqual(self.o.get_options(['one', 'two', 'three', 'four']),
+                         {'one': 'one', 'two': 'two', 'three': 3, 'four': None})
+
+    def test_writes_dropped_on_error(self):
+        try:
+            with self.o.snapshot():
+                self.assertTrue(self.o.update_option('one', 'one'))
+                self.assertTrue(self.o.add_option('three', 3))
+                raise ValueError
+        except ValueError:
+            pass
+        self.assertEqual(self.o.get_options(['one', 'three']), {'one': 1, 'three': None})
+        self.assertFalse(Option.all.filter(key='three').exists())
+
+    def test_middleware(self):
+        from django.http import HttpRequest, HttpResponse
+        from .middleware import OptionsLoaderMiddleware
+
+        with override_settings(OPTIONS_REQUEST_SNAPSHOT=True):
+            middleware = OptionsLoaderMiddleware()
+
+        request = HttpRequest()
+        middleware.process_request(request)
+        self.assertTrue(self.o.update_option('one', 'one'))
+        self.assertEqual(Option.all.get(key='one').value, 1)
+        middleware.process_response(request, HttpResponse())
+        self.assertEqual(Option.all.get(key='one').value, 'one')
+
+        # a failed request writes nothing
+        middleware.process_request(request)
+        self.assertTrue(self.o.update_option('two', 'two'))
+        middleware.process_exception(request, ValueError())
+        middleware.process_response(request, HttpResponse(status=500))
+        self.assertEqual(Option.all.get(key='two').value, 2)
+        self.assertEqual(self.o.get_option('two'), 2)
+
+
+class OptionThreadingTestCase(OptionTestCase):
+
+    def setUp(self):
+        super(OptionThreadingTestCase, self).setUp()
+        self.fetches, self.coalesced = self.o.fetches, self.o.coalesced
+
+    def run_threads(self, target, count=8):
+        errors = []
+        def run():
+            try:
+                target()
+            except Exception, e:
+                errors.append(e)
+        threads = [threading.Thread(target=run) for i in range(count)]
+        for thread in threads:
+            thread.start()
+        return threads, errors
+
+    def test_lru_cache_concurrent_access(self):
+        cache = LRUCache(50)
+        def hammer():
+            for i in range(2000):
+                cache[i % 97] = i
+                cache.get((i * 7) % 97)
+                cache.pop((i * 3) % 97, None)
+        threads, errors = self.run_threads(hammer)
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        self.assertTrue(len(cache) <= 50)
+
+    def test_readers_during_writes(self):
+        keys = ['key_%s' % i for i in range(5)]
+        for key in keys:
+            self.assertTrue(self.o.add_option(key, 0))
+        self.o.clear()
+        for key in keys:
+            self.assertEqual(self.o.get_option(key), 0)
+
+        done = []
+        seen = set()
+        def read():
+            # cached keys only, database connections are per thread
+            while not done:
+                for key in keys:
+                    seen.add(self.o.get_option(key))
+        threads, errors = self.run_threads(read)
+        try:
+            for i in range(1, 50):
+                for key in keys:
+                    self.assertTrue(self.o.update_option(key, i))
+        finally:
+            done.append(True)
+            for thread in threads:
+                thread.join()
+
+        self.assertEqual(errors, [])
+        self.assertNotIn(None, seen)
+        for key in keys:
+            self.assertEqual(self.o.get_option(key), 49)
+
+    def test_concurrent_misses_are_coalesced(self):
+        calls = []
+        def query_options(keys, seq):
+            # database connections are per thread, so no queries here
+            calls.append(keys)
+            time.sleep(0.05)
+            return dict.fromkeys(keys, 'value')
+        self.patch(self.o, query_options=query_options)
+        results = []
+        threads, errors = self.run_threads(lambda: results.append(self.o.fetch_options(['foo'])))
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(errors, [])
+        self.assertEqual(results, [{'foo': 'value'}] * 8)
+        self.assertEqual(calls, [['foo']])
+        stats = self.o.cache_stats()
+        self.assertEqual((stats['fetches'], stats['coalesced']), (self.fetches + 1, self.coalesced + 7))
+        self.assertEqual(self.o.flights, {})
+
+    def test_fetches_before_a_write_are_not_joined(self):
+        self.assertTrue(self.o.add_option('foo', 'bar', autoload=False))
+        self.o.clear()
+        # in flight since before the write, never completed
+        self.o.flights['foo'] = Flight(self.o.write_seq - 2)
+        try:
+            self.assertEqual(self.o.get_option('foo'), 'bar')
+        finally:
+            self.o.flights.clear()
+
+    def test_racing_reads_are_not_cached(self):
+        self.assertTrue(self.o.add_option('foo', 'bar'))
+        seq = self.o.write_seq
+        self.assertTrue(self.o.can_cache(seq))
+        self.assertTrue(self.o.update_option('foo', 'baz'))
+        # a value read before the write is stale
+        self.assertFalse(self.o.can_cache(seq))
+        self.assertTrue(self.o.can_cache(self.o.write_seq))
+
+
+class OptionStaleWhileRevalidateTestCase(OptionTestCase):
+
+    def setUp(self):
+        super(OptionStaleWhileRevalidateTestCase, self).setUp()
+        self.pending = []
+        # database connections are per thread, so run later in this thread
+        self.patch(self.o, stale_ttl=60, spawn=lambda target, *args: self.pending.append((target, args)))
 
+    def run_pending(self):
+        for target, args in self.pending:
+            target(*args)
+        self.pending = []
 
+    def test_stale_value_is_served_while_revalidating(self):
+        self.assertTrue(self.o.add_option('foo', 'bar', autoload=False))
+        self.assertTrue(self.o.add_option('one', 1))
+        self.assertIsNone(self.o.get_option('new'))
+        # changed by another process
+        Option.all.filter(key='foo').update(value='baz')
+        Option.all.filter(key='one').delete()
+        Option.all.create(key='new', value=True, site_id=self.o.get_site_id())
+
+        with self.assertNumQueries(0):
+            self.o.reload(['foo', 'one', 'new'])
+            self.assertEqual(self.o.get_option('foo'), 'bar')
+            self.assertEqual(self.o.get_option('one'), 1)
+            self.assertIsNone(self.o.get_option('new'))
+        self.assertEqual(len(self.pending), 1)
+
+        changes = []
+        def collect(sender, **kwargs):
+            changes.append((kwargs['option'], kwargs['old_value'], kwargs['new_value']))
+        option_value_changed.connect(collect)
+        try:
+            self.run_pending()
+        finally:
+            option_value_changed.disconnect(collect)
+        self.assertEqual(sorted(changes), [('foo', 'bar', 'baz'), ('new', None, True), ('one', 1, None)])
+
+        with self.assertNumQueries(0):
+            self.assertEqual(self.o.get_option('foo'), 'baz')
+            self.assertIsNone(self.o.get_option('one'))
+            self.assertTrue(self.o.get_option('new'))
+        self.assertEqual(self.o.stale, {})
+
+    def test_max_staleness(self):
+        self.assertTrue(self.o.add_option('foo', 'bar', autoload=False))
+        Option.all.filter(key='foo').update(value='baz')
+        self.o.reload(['foo'])
+        self.assertEqual(self.o.get_option('foo'), 'bar')
+
+        self.o.stale['foo'] = ('bar', time.time() - 61)
+        with self.assertNumQueries(1):
+            self.assertEqual(self.o.get_option('foo'), 'baz')
+
+    def test_local_write_ends_revalidation(self):
+        self.assertTrue(self.o.add_option('foo', 'bar', autoload=False))
+        self.o.reload(['foo'])
+        self.assertTrue(self.o.update_option('foo', 'local'))
+        self.assertEqual(self.o.stale, {})
+        self.run_pending()
+        self.assertEqual(self.o.get_option('foo'), 'local')
+
+
+class OptionSitePartitionTestCase(OptionTestCase):
+
+    def setUp(self):
+        from django.contrib.sites.models import Site
+        super(OptionSitePartitionTestCase, self).setUp()
+        self.addCleanup(self.o.sites.clear)
+        self.site = Site.objects.create(domain='other.example.com', name='other')
+
+    def test_partitions(self):
+        other = self.o.for_site(self.site.pk)
+        self.assertIs(self.o.for_site(self.site.pk), other)
+        self.assertIs(other.for_site(self.o.get_site_id()), self.o)
+        self.assertIs(self.o.for_site(None), self.o)
+        self.assertEqual(other.get_site_id(), self.site.pk)
+
+        self.assertTrue(self.o.add_option('welcome', 'Hello'))
+        self.assertTrue(other.add_option('welcome', 'Ciao'))
+        self.assertEqual(Option.all.filter(key='welcome').count(), 2)
+
+        # caches are not mixed
+        self.assertEqual(self.o.get_option('welcome'), 'Hello')
+        with self.assertNumQueries(0):
+            self.assertEqual(other.get_option('welcome'), 'Ciao')
+        self.assertTrue(other.update_option('welcome', 'Salve'))
+        self.assertEqual(self.o.get_option('welcome'), 'Hello')
+
+        # autoload snapshot per site
+        other.clear()
+        self.assertEqual(other.fetch_all_options(), {'welcome': other.all_options['welcome']})
+        self.assertEqual(other.get_option('welcome'), 'Salve')
+
+        self.assertTrue(other.delete_option('welcome'))
+        self.assertEqual(self.o.get_option('welcome'), 'Hello')
+
+    def test_partitions_sync_with_requests(self):
+        from django.http import HttpRequest
+        from .middleware import OptionsLoaderMiddleware
+
+        self.use_settings(OPTIONS_INVALIDATION_BACKEND='django_options.invalidation.DatabaseInvalidationBackend',
+                          OPTIONS_INVALIDATION_INTERVAL=None)
+        # configured again from settings
+        self.patch(self.o, invalidation=None, next_sync=None)
+        other = self.o.for_site(self.site.pk)
+        self.assertTrue(other.add_option('foo', 'bar'))
+        self.assertEqual(other.get_option('foo'), 'bar')
+
+        # another process changes the option
+        Option.all.filter(key='foo').update(value='changed')
+        DatabaseInvalidationBackend().publish(self.site.pk, ['foo'])
+
+        OptionsLoaderMiddleware().process_request(HttpRequest())
+        self.assertEqual(other.get_option('foo'), 'changed')
+
+    def test_partitions_are_bounded(self):
+        self.patch(self.o, sites=LRUCache(1))
+        first = self.o.for_site(self.site.pk)
+        self.o.for_site(self.site.pk + 1)
+        self.assertIsNot(self.o.for_site(self.site.pk), first)
+
+
+class SiteOptions(OptionSchema):
+    site_title = OptionField(basestring, 'My site')
+    items_per_page = OptionField(int, 10, autoload=False)
+    promo_banner = OptionField(basestring, key='promo.banner', ttl=60)
+
+
+class OptionSchemaTestCase(OptionTestCase):
+
+    def setUp(self):
+        super(OptionSchemaTestCase, self).setUp()
+        self.options = SiteOptions()
+
+    def test_defaults_and_types(self):
+        with self.assertNumQueries(2):
+            self.assertEqual(self.options.site_title, 'My site')
+        with self.assertNumQueries(0):
+            self.assertEqual(self.options.items_per_page, 10)
+            self.assertIsNone(self.options.promo_banner)
+        self.assertRaises(AttributeError, getattr, self.options, 'site_titel')
+        self.assertRaises(AttributeError, setattr, self.options, 'site_titel', 'typo')
+
+        self.assertTrue(self.o.add_option('items_per_page', '25'))
+        self.assertEqual(self.options.items_per_page, 25)
+        self.assertTrue(self.o.update_option('items_per_page', 'many'))
+        self.assertEqual(self.options.items_per_page, 10)
+
+    def test_install_and_set(self):
+        self.assertEqual(self.options.install(), {'site_title': True, 'items_per_page': True})
+        self.assertFalse(Option.all.get(key='items_per_page').autoload)
+
+        self.options.promo_banner = 'Sales!'
+        option = Option.all.get(key='promo.banner')
+        self.assertEqual(option.value, 'Sales!')
+        self.assertIsNotNone(option.expires_at)
+        self.assertEqual(self.options.promo_banner, 'Sales!')
+        self.assertEqual(self.options.as_dict(), {'site_title': 'My site', 'items_per_page': 10, 'promo_banner': 'Sales!'})
+
+    def test_changes_are_seen(self):
+        self.assertEqual(self.options.site_title, 'My site')
+        self.o.update_option('site_title', 'Other site')
+        self.assertEqual(self.options.site_title, 'Other site')
+        self.o.clear()
+        self.assertEqual(self.options.site_title, 'Other site')
+
+    def test_invalid_default(self):
+        self.assertRaises(ImproperlyConfigured, type, 'Invalid', (OptionSchema,), {'count': OptionField(int, 'ten')})
+
+    def test_boolean_strings(self):
+        field = OptionField(bool, True)
+        for value in ('false', 'False', '0', 'no', ' off ', ''):
+            self.assertIs(field.to_python(value), False)
+        for value in ('true', '1', 'yes', 'on'):
+            self.assertIs(field.to_python(value), True)
+        self.assertIs(field.to_python('maybe'), True)
+        self.assertIs(field.to_python(0), False)
+
+    def test_invalid_writes(self):
+        self.assertTrue(self.o.add_option('items_per_page', 25))
+        self.assertRaises(ValueError, setattr, self.options, 'items_per_page', 'abc')
+        self.assertRaises(ValueError, self.options.set, 'site_title', 5)
+        self.assertRaises(ValueError, OptionField(bool, True).clean, 'maybe')
+        self.assertEqual(Option.all.get(key='items_per_page').value, 25)
+        self.assertFalse(Option.all.filter(key='site_title').exists())
+
+        self.options.items_per_page = '30'
+        self.assertEqual(Option.all.get(key='items_per_page').value, 30)
+        self.assertEqual(self.options.items_per_page, 30)
+
+    def test_snapshot_writes_are_seen(self):
+        self.assertEqual(self.options.site_title, 'My site')
+        with self.o.snapshot():
+            self.options.site_title = 'New site'
+            self.assertFalse(Option.all.filter(key='site_title').exists())
+            self.assertEqual(self.options.site_title, 'New site')
+            self.options.load()
+            self.assertEqual(self.options.as_dict()['site_title'], 'New site')
+        self.assertEqual(self.options.site_title, 'New site')
+
+        try:
+            with self.o.snapshot():
+                self.options.site_title = 'Dropped'
+                self.options.load()
+                raise ValueError
+        except ValueError:
+            pass
+        self.assertEqual(self.options.site_title, 'New site')
+
+    def test_changes_of_other_processes_are_seen(self):
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        self.addCleanup(os.remove, path)
+        self.patch(self.o, invalidation=FileInvalidationBackend(path=path), invalidation_interval=0, next_sync=0)
+        self.assertTrue(self.o.add_option('site_title', 'My site'))
+        self.assertEqual(self.options.site_title, 'My site')
+        # another process changes the option
+        Option.all.filter(key='site_title').update(value='Other site')
+        FileInvalidationBackend(path=path).publish(self.o.get_site_id(), ['site_title'])
+        self.assertEqual(self.options.site_title, 'Other site')
+
+
+class OptionCodecTestCase(OptionTestCase):
+
+    def setUp(self):
+        super(OptionCodecTestCase, self).setUp()
+        self.field = Option._meta.get_field('value')
+
+    def raw_value(self, key):
+        # as stored, not decoded by django >= 1.8
+        return Option.all.filter(key=key).raw_values_list('value')[0][0]
+
+    def test_json_codec(self):
+        self.patch(self.field, codec=get_codec('json'))
+        values = {'int': 1, 'text': u'ciao', 'menu': {'items': [u'home', u'blog'], 'size': 2.5}, 'flag': False, 'tuple': (1, 2)}
+        self.assertEqual(self.o.add_options(values), dict.fromkeys(values, True))
+
+        self.assertEqual(self.raw_value('int'), '~json~1')
+        self.assertEqual(self.raw_value('menu'), '~json~{"items":["home","blog"],"size":2.5}')
+        # not representable in json
+        self.assertFalse(self.raw_value('tuple').startswith('~'))
+
+        self.o.clear()
+        self.assertEqual(self.o.get_options(values.keys()), values)
+
+    def test_string_like_an_encoded_value(self):
+        self.patch(self.field, codec=get_codec('json'))
+        self.assertTrue(self.o.add_option('foo', '~json~{'))
+        self.o.clear()
+        self.assertEqual(self.o.get_option('foo'), '~json~{')
+
+    def test_strings_like_encoded_values(self):
+        for codec in ('pickle', 'json'):
+            self.patch(self.field, codec=get_codec(codec))
+            Option.all.all().delete()
+            self.o.clear()
+            # pickled 1 too
+            values = {'int': u'~json~1', 'list': '~json~[1,2]', 'unknown': u'~msgpack~x', 'pickled': 'gAJLAS4='}
+            self.assertEqual(self.o.add_options(values), dict.fromkeys(values, True))
+            self.assertTrue(self.o.add_option('real', [1, 2]))
+            self.o.clear()
+            self.assertEqual(self.o.get_options(values.keys()), values)
+            # model instances too
+            self.assertEqual(Option.all.get(key='int').value, u'~json~1')
+            self.assertEqual(Option.objects.get(key='real').value, [1, 2])
+
+            option = Option.all.get(key='list')
+            option.value = u'~json~2'
+            option.save()
+            self.assertEqual(Option.all.get(key='list').value, u'~json~2')
+
+            # and recoded as they are
+            self.patch(self.field, codec=get_codec('json' if codec == 'pickle' else 'pickle'))
+            self.o.recode_options()
+            self.o.clear()
+            values['list'] = u'~json~2'
+            self.assertEqual(self.o.get_options(values.keys()), values)
+
+    def test_recode(self):
+        self.patch(self.field, codec=get_codec('pickle'))
+        self.assertEqual(self.o.add_options({'one': 1, 'two': [2], 'three': (3,)}), {'one': True, 'two': True, 'three': True})
+        self.assertFalse(self.raw_value('one').startswith('~'))
+
+        self.patch(self.field, codec=get_codec('json'))
+        self.assertEqual(self.o.recode_options(batch_size=2), 2)
+        self.assertEqual(self.raw_value('one'), '~json~1')
+        self.assertEqual(self.o.recode_options(), 0)
+
+        self.o.clear()
+        self.assertEqual(self.o.get_options(['one', 'two', 'three']), {'one': 1, 'two': [2], 'three': (3,)})
+
+    def test_unknown_codec(self):
+        self.assertRaises(ImproperlyConfigured, get_codec, 'xml')
+
+
+class OptionLazyLoadingTestCase(OptionTestCase):
+
+    def setUp(self):
+        super(OptionLazyLoadingTestCase, self).setUp()
+        self.patch(self.o, lazy_threshold=40)
+
+    def test_large_values_are_fetched_on_access(self):
+        self.assertTrue(self.o.add_option('small', 'ciao'))
+        self.assertTrue(self.o.add_option('html', '<p>%s</p>' % ('x' * 100)))
+        self.assertTrue(self.o.add_option('menu', ['home', 'blog', 'about'] * 10))
+        self.assertTrue(self.o.add_option('empty', None))
+        self.o.clear()
+
+        with self.assertNumQueries(1):
+            all_options = self.o.fetch_all_options()
+        self.assertEqual(sorted(all_options), ['empty', 'html', 'menu', 'small'])
+        self.assertIsInstance(all_options['html'], LazyValue)
+        self.assertIsInstance(all_options['menu'], LazyValue)
+        self.assertNotIsInstance(all_options['small'], LazyValue)
+
+        with self.assertNumQueries(0):
+            self.assertEqual(self.o.get_option('small'), 'ciao')
+            self.assertIsNone(self.o.get_option('empty'))
+        with self.assertNumQueries(1):
+            self.assertEqual(self.o.get_options(['html', 'menu', 'small']), {
+                'html': '<p>%s</p>' % ('x' * 100),
+                'menu': ['home', 'blog', 'about'] * 10,
+                'small': 'ciao',
+            })
+        with self.assertNumQueries(0):
+            self.assertEqual(self.o.get_option('menu'), ['home', 'blog', 'about'] * 10)
+        # the option exists
+        self.assertFalse(self.o.add_option('html', 'other'))
+
+
+class OptionFrozenValuesTestCase(OptionTestCase):
+
+    def setUp(self):
+        super(OptionFrozenValuesTestCase, self).setUp()
+        self.patch(self.o, freeze_values=True)
+
+    def test_freeze(self):
+        value = {'menu': ['home', 'blog'], 'size': (1, [2]), 'tags': set(['a'])}
+        frozen = freeze(value)
+        self.assertEqual(frozen, {'menu': ['home', 'blog'], 'size': (1, [2]), 'tags': frozenset(['a'])})
+        self.assertIsInstance(frozen, FrozenDict)
+        self.assertIsInstance(frozen['menu'], FrozenList)
+        self.assertIsInstance(frozen['size'][1], FrozenList)
+        self.assertIs(freeze(frozen), frozen)
+        self.assertIs(copy.deepcopy(frozen), frozen)
+        self.assertRaises(TypeError, frozen.update, {'size': 0})
+        self.assertRaises(TypeError, frozen['menu'].append, 'about')
+        self.assertEqual(pickle.loads(pickle.dumps(frozen, 2)), frozen)
+        self.assertEqual(pickle.loads(pickle.dumps(frozen, 0)), frozen)
+
+    def test_cached_values_are_read_only(self):
+        menu = {'items': ['home', 'blog']}
+        self.assertTrue(self.o.add_option('menu', menu))
+        # the caller keeps its own value
+        menu['items'].append('about')
+
+        value = self.o.get_option('menu')
+        self.assertEqual(value, {'items': ['home', 'blog']})
+        self.assertRaises(TypeError, value['items'].append, 'about')
+        self.assertIs(self.o.get_option('menu'), value)
+        self.assertFalse(self.o.update_option('menu', {'items': ['home', 'blog']}))
+
+        self.o.clear()
+        value = self.o.get_option('menu')
+        self.assertIsInstance(value, FrozenDict)
+        self.assertRaises(TypeError, value.__setitem__, 'items', [])
+
+        changed = value.copy()
+        changed['items'] = list(value['items']) + ['about']
+        self.assertTrue(self.o.update_option('menu', changed))
+        self.assertEqual(self.o.get_option('menu'), {'items': ['home', 'blog', 'about']})
+
+    def test_stored_values_are_plain(self):
+        field = Option._meta.get_field('value')
+        for codec in ('pickle', 'json'):
+            self.patch(field, codec=get_codec(codec))
+            Option.all.all().delete()
+            self.patch(self.o, freeze_values=True)
+            self.o.clear()
+            self.assertTrue(self.o.add_option('menu', {'items': ['home'], 'tags': set(['a'])}))
+            self.assertTrue(self.o.update_options({'list': [[1]]}))
+            self.assertIsInstance(self.o.get_option('menu'), FrozenDict)
+
+            # frozen values written back are stored plain too
+            self.assertTrue(self.o.update_option('copy', self.o.get_option('menu')))
+
+            self.patch(self.o, freeze_values=False)
+            self.o.clear()
+            for key in ('menu', 'copy'):
+                menu = self.o.get_option(key)
+                self.assertIs(type(menu), dict)
+                self.assertIs(type(menu['items']), list)
+                self.assertIs(type(menu['tags']), set)
+                menu['items'].append('blog')
+            self.assertIs(type(self.o.get_option('list')[0]), list)
+
+    def test_thaw(self):
+        value = {'menu': ['home'], 'size': (1, [2]), 'tags': set(['a']), 'fixed': frozenset(['b'])}
+        thawed = thaw(freeze(value))
+        self.assertEqual(thawed, value)
+        self.assertIs(type(thawed), dict)
+        self.assertIs(type(thawed['size'][1]), list)
+        self.assertIs(type(thawed['tags']), set)
+        self.assertIs(type(thawed['fixed']), frozenset)
+
+
+class OptionMetricsTestCase(OptionTestCase):
+
+    def setUp(self):
+        super(OptionMetricsTestCase, self).setUp()
+        self.sent = []
+        self.patch(self.o, metrics=OptionMetrics(hot_keys=2, hook=lambda *args: self.sent.append(args)))
+
+    def test_counters(self):
+        self.assertTrue(self.o.add_option('one', 1))
+        self.assertTrue(self.o.add_option('two', 2, autoload=False))
+        self.o.clear()
+        self.o.metrics.reset()
+
+        self.assertEqual(self.o.get_option('one'), 1)
+        self.assertEqual(self.o.get_option('one'), 1)
+        self.assertEqual(self.o.get_option('two'), 2)
+        self.assertIsNone(self.o.get_option('three'))
+        self.assertIsNone(self.o.get_option('three'))
+
+        stats = self.o.stats()
+        self.assertEqual(stats['counters'], {
+            'autoload_hits': 1, 'hits': 1, 'misses': 2, 'negative_hits': 1, 'queries': 3,
+        })
+        self.assertEqual(sorted(stats['timers']), ['fetch', 'load_all_options'])
+        self.assertEqual(stats['timers']['fetch']['count'], 2)
+        self.assertEqual(stats['hot_keys'], [('one', 2), ('three', 2)])
+        self.assertIn('single_options', stats['caches'])
+        self.assertIn(('incr', 'misses', 1), self.sent)
+
+    def test_handles_are_counted(self):
+        self.assertTrue(self.o.add_option('one', 1))
+        self.o.clear()
+        self.o.metrics.reset()
+
+        one, three = self.o.handle('one'), self.o.handle('three')
+        for i in range(2):
+            self.assertEqual(one.get(), 1)
+            self.assertIsNone(three.get())
+
+        stats = self.o.stats()
+        self.assertEqual(stats['counters'], {
+            'autoload_hits': 1, 'hits': 1, 'misses': 1, 'negative_hits': 1, 'queries': 2,
+        })
+        self.assertEqual(stats['hot_keys'], [('one', 2), ('three', 2)])
+
+    def test_write_timers(self):
+        self.assertTrue(self.o.update_option('one', 1))
+        timers = self.o.stats()['timers']
+        self.assertEqual(timers['update_option']['count'], 1)
+        self.assertEqual(timers['add_option']['count'], 1)
+        self.assertTrue(timers['update_option']['max'] >= timers['add_option']['max'])
+
+    def test_hot_keys_are_bounded(self):
+        metrics = OptionMetrics(hot_keys=2)
+        for i in range(100):
+            metrics.read('hot')
+            metrics.read('key_%s' % i)
+        self.assertTrue(len(metrics.reads) <= 20)
+        self.assertEqual(metrics.stats()['hot_keys'][0], ('hot', 100))
+
+
+class OptionTemplateTestCase(OptionTestCase):
+
+    def setUp(self):
+        super(OptionTemplateTestCase, self).setUp()
+        self.reads = []
+        read_option = self.o.read_option
+        def counted_read_option(key, default=None):
+            self.reads.append(key)
+            return read_option(key, default)
+        self.patch(self.o, read_option=counted_read_option)
+
+    def render(self, source, **context):
+        return Template('{% load options %}' + source).render(Context(context))
+
+    def test_bound_tag(self):
+        self.assertTrue(self.o.add_option('title', 'Hello'))
+        self.reads = []
+        template = Template('{% load options %}{% for i in items %}{% option "title" %}{% option "missing" "-" %}{% endfor %}')
+        self.assertEqual(template.render(Context({'items': range(3)})), 'Hello-' * 3)
+        self.assertEqual(sorted(self.reads), ['missing', 'title'])
+
+        self.reads = []
+        with self.assertNumQueries(0):
+            self.assertEqual(template.render(Context({'items': range(3)})), 'Hello-' * 3)
+        self.assertEqual(self.reads, [])
+
+        self.assertTrue(self.o.update_option('title', 'Bye'))
+        self.reads = []
+        self.assertEqual(template.render(Context({'items': range(2)})), 'Bye-' * 2)
+        self.assertEqual(sorted(self.reads), ['missing', 'title'])
+
+    def test_tag_arguments(self):
+        self.assertTrue(self.o.add_option('title', 'Hello'))
+        self.assertEqual(self.render('{% option "missing" default as value %}[{{ value }}]', default='x'), '[x]')
+        self.assertEqual(self.render('{% option key %}', key='title'), 'Hello')
+        self.assertEqual(self.render('{% option "TITLE"|lower %}'), 'Hello')
+
+    def test_filters(self):
+        self.assertTrue(self.o.add_option('items', [1, 2]))
+        self.assertEqual(self.render("{% for i in 'items'|option %}{{ i }}{% endfor %}"), '12')
+        self.assertEqual(self.render("{{ 'missing'|option:'none' }}"), 'none')
+        self.assertEqual(self.render("{{ value|or_option:'items' }}", value=''), '[1, 2]')
+        self.reads = []
+        self.render("{{ 'items'|option }}{{ 'items'|option }}")
+        self.assertEqual(self.reads, [])
+
+    def test_expiry(self):
+        self.assertTrue(self.o.add_option('soon', 1, ttl=1))
+        handle = self.o.handle('soon')
+        self.assertEqual(handle.get(), 1)
+        handle.deadline = time.time() - 1
+        self.o.expires['soon'] = timezone.now() - timedelta(seconds=1)
+        self.assertIsNone(handle.get())
+
+
+class OptionTemplatePrefetchTestCase(OptionTestCase):
+
+    def setUp(self):
+        super(OptionTemplatePrefetchTestCase, self).setUp()
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        self.write('base.html', '{% load options %}{% option "base" %}|{% block content %}{% endblock %}')
+        self.write('include.html', "{% load options %}{{ value|or_option:'included' }}")
+        self.write('page.html', '{% extends "base.html" %}{% load options %}{% block content %}'
+                   "{% if 'flag'|option %}{% option 'title' %}{% endif %}{% include 'include.html' %}"
+                   '{% for i in items %}{% option key %}{% endfor %}{% endblock %}')
+        self.use_settings(
+            TEMPLATE_DIRS=(self.dir,),
+            TEMPLATE_LOADERS=(('django_options.loaders.Loader', ('django.template.loaders.filesystem.Loader',)),),
+        )
+        # loaders are built again from settings
+        self.patch(loader, template_source_loaders=None)
+
+    def write(self, name, source):
+        with open(os.path.join(self.dir, name), 'w') as f:
+            f.write(source)
+
+    def test_collect_keys(self):
+        template = loader.get_template('page.html')
+        self.assertEqual(template_option_keys(template.template), frozenset(['base', 'flag', 'title', 'included']))
+
+    def test_proxy_keys(self):
+        self.write('proxy.html', '{% include "include.html" %}{{ options.site_title }}{% if options.flag %}{{ options.flag.name }}{% endif %}')
+        template = loader.get_template('proxy.html').template
+        self.assertEqual(template_option_keys(template), frozenset(['included', 'site_title', 'flag']))
+        self.assertEqual(template.option_proxy_keys, frozenset(['site_title', 'flag']))
+
+    def test_proxy_single_lookup(self):
+        for key in ('title', 'flag'):
+            self.assertTrue(self.o.add_option(key, key.upper(), autoload=False))
+        self.o.clear()
+        self.o.fetch_all_options()
+        self.write('proxy.html', '{{ options.title }}{% if options.flag %}!{% endif %}[{{ options.missing }}]')
+
+        template = loader.get_template('proxy.html')
+        options = OptionsProxy()
+        with self.assertNumQueries(1):
+            self.assertEqual(template.render(Context({'options': options})), 'TITLE![]')
+        self.assertEqual(options._expected, set())
+        with self.assertNumQueries(0):
+            self.assertEqual(template.render(Context({'options': OptionsProxy()})), 'TITLE![]')
+
+    def test_single_query(self):
+        for key in ('base', 'flag', 'title', 'included'):
+            self.assertTrue(self.o.add_option(key, key.upper(), autoload=False))
+        self.o.clear()
+        self.o.fetch_all_options()
+
+        template = loader.get_template('page.html')
+        with self.assertNumQueries(1):
+            self.assertEqual(template.render(Context({'items': []})), 'BASE|TITLEINCLUDED')
+        with self.assertNumQueries(0):
+            self.assertEqual(template.render(Context({'items': []})), 'BASE|TITLEINCLUDED')
+
+        self.assertTrue(self.o.update_option('title', 'Changed', autoload=False))
+        with self.assertNumQueries(0):
+            self.assertEqual(template.render(Context({'items': []})), 'BASE|ChangedINCLUDED')
+
+
+class OptionsProxyTestCase(OptionTestCase):
+
+    def test_access(self):
+        self.assertTrue(self.o.add_option('title', 'Hello'))
+        options = options_processor(None)['options']
+        self.assertEqual(options['title'], 'Hello')
+        self.assertEqual(options.title, 'Hello')
+        self.assertEqual(options.get('missing', 'x'), 'x')
+        self.assertTrue('title' in options)
+        self.assertFalse('missing' in options)
+        self.assertRaises(KeyError, lambda: options['missing'])
+        self.assertRaises(AttributeError, lambda: options.missing)
+        self.assertEqual(Template('{{ options.title }}|{{ options.missing }}').render(Context({'options': options})), 'Hello|')
+
+    def test_consistent_values(self):
+        self.assertTrue(self.o.add_option('title', 'Hello'))
+        options = OptionsProxy()
+        self.assertEqual(options['title'], 'Hello')
+        self.assertTrue(self.o.update_option('title', 'Bye'))
+        self.assertEqual(options['title'], 'Hello')
+        self.assertEqual(OptionsProxy()['title'], 'Bye')
+
+    def test_expected_keys(self):
+        self.assertTrue(self.o.add_option('one', 1, autoload=False))
+        self.assertTrue(self.o.add_option('two', 2, autoload=False))
+        self.o.clear()
+        self.o.all_options = {}
+        options = OptionsProxy()
+        options.expect(['one', 'two', 'three'])
+        with self.assertNumQueries(1):
+            self.assertEqual(options['one'], 1)
+            self.assertEqual(options['two'], 2)
+            self.assertFalse('three' in options)
+
+
+class OptionFragmentCacheTestCase(OptionTestCase):
+
+    def setUp(self):
+        super(OptionFragmentCacheTestCase, self).setUp()
+        cache.clear()
+        self.addCleanup(cache.clear)
+
+    def test_versions(self):
+        self.assertTrue(self.o.add_option('title', 'Hello'))
+        handle = self.o.handle('title')
+        version = handle.version()
+        self.assertEqual(len(version), 32)
+        self.assertEqual(self.o.handle('missing').version(), '')
+        self.o.clear()
+        self.assertEqual(handle.version(), version)
+
+        self.assertTrue(self.o.update_option('title', 'Bye'))
+        self.assertNotEqual(handle.version(), version)
+        self.assertTrue(self.o.update_option('title', 'Hello'))
+        self.assertEqual(handle.version(), version)
+
+        versions = options_version(['title', 'missing'])
+        self.assertNotEqual(options_version(['missing', 'title']), versions)
+        self.assertTrue(self.o.add_option('missing', None))
+        self.assertNotEqual(options_version(['title', 'missing']), versions)
+
+    def test_cache_key(self):
+        self.assertTrue(self.o.add_option('title', 'Hello'))
+        key = options_cache_key('sidebar', ['title'], [1])
+        self.assertTrue(key.startswith('template.cache.sidebar.'))
+        self.assertNotEqual(options_cache_key('sidebar', ['title'], [2]), key)
+        self.assertTrue(self.o.update_option('title', 'Bye'))
+        self.assertNotEqual(options_cache_key('sidebar', ['title'], [1]), key)
+
+    def test_tag(self):
+        self.assertTrue(self.o.add_option('title', 'Hello'))
+        template = Template('{% load options %}{% cache_with_options 60 header "title" vary_on user %}'
+                            '{% option "title" %} {{ user }} {{ count }}{% endcache_with_options %}')
+        self.assertEqual(template.render(Context({'user': 'ann', 'count': 1})), 'Hello ann 1')
+        self.assertEqual(template.render(Context({'user': 'ann', 'count': 2})), 'Hello ann 1')
+        self.assertEqual(template.render(Context({'user': 'bob', 'count': 3})), 'Hello bob 3')
+        self.assertEqual(cache.get(options_cache_key('header', ['title'], ['ann'])), 'Hello ann 1')
+
+        self.assertTrue(self.o.update_option('title', 'Bye'))
+        self.assertEqual(template.render(Context({'user': 'ann', 'count': 4})), 'Bye ann 4')
+        self.assertEqual(template.nodelist[1].option_keys, ['title'])
+
+
+class OptionConditionalResponseTestCase(OptionTestCase):
+
+    def setUp(self):
+        super(OptionConditionalResponseTestCase, self).setUp()
+        self.calls = []
+
+    def view(self, request):
+        self.calls.append(request)
+        return HttpResponse('ok')
+
+    def request(self, view, **headers):
+        request = RequestFactory().get('/', **headers)
+        return view(request)
+
+    def test_modified(self):
+        self.assertTrue(self.o.add_option('one', 1))
+        self.assertTrue(self.o.add_option('two', 2))
+        Option.all.filter(key='one').update(updated_at=timezone.now() - timedelta(days=1))
+        self.o.clear()
+
+        one = self.o.options_modified(['one'])
+        both = self.o.options_modified(['one', 'two'])
+        self.assertTrue(one < both)
+        self.assertIsNone(self.o.options_modified(['one', 'missing']))
+        with self.assertNumQueries(0):
+            self.assertEqual(self.o.options_modified([' one ']), one)
+
+        self.assertTrue(self.o.update_option('one', 'changed'))
+        self.assertTrue(self.o.options_modified(['one']) > one)
+        self.assertTrue(self.o.delete_option('two'))
+        self.assertIsNone(self.o.options_modified(['two']))
+
+    def test_site_version(self):
+        self.assertTrue(self.o.add_option('one', 1))
+        version = self.o.options_version()
+        with self.assertNumQueries(0):
+            self.assertEqual(self.o.options_version(), version)
+        self.assertTrue(self.o.add_option('two', 2))
+        changed = self.o.options_version()
+        self.assertNotEqual(changed, version)
+        self.assertTrue(self.o.delete_option('two'))
+        self.assertNotEqual(self.o.options_version(), changed)
 
+    def test_site_version_without_expired_options(self):
+        self.assertTrue(self.o.add_option('one', 1))
+        version = self.o.options_version()
+        self.assertTrue(self.o.add_option('gone', 2, expires_at=timezone.now() - timedelta(seconds=1)))
+        self.assertEqual(self.o.options_version(), version)
 
+        self.assertTrue(self.o.add_option('soon', 3, ttl=60))
+        changed = self.o.options_version()
+        self.assertNotEqual(changed, version)
+        self.assertIsNotNone(self.o.options_modified(['soon']))
+        # expires without any write, dates cached before the expiry
+        Option.all.filter(key='soon').update(expires_at=timezone.now() - timedelta(seconds=1))
+        dates = self.o.modified_dates()
+        dates[None] = dates[None][:2] + (timezone.now(),)
+        dates['soon'] = (dates['soon'][0], timezone.now())
+        self.assertEqual(self.o.options_version(), version)
+        self.assertIsNone(self.o.options_modified(['soon']))
 
+    def test_condition(self):
+        self.assertTrue(self.o.add_option('title', 'Hello'))
+        view = condition_on_options(['title'])(self.view)
+        response = self.request(view)
+        self.assertEqual(response.status_code, 200)
+        etag, last_modified = response['ETag'], response['Last-Modified']
 
+        self.assertEqual(self.request(view, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        self.assertEqual(self.request(view, HTTP_IF_MODIFIED_SINCE=last_modified).status_code, 304)
+        self.assertEqual(len(self.calls), 1)
 
+        self.assertTrue(self.o.update_option('title', 'Bye'))
+        self.assertEqual(self.request(view, HTTP_IF_NONE_MATCH=etag).status_code, 200)
+        self.assertTrue(self.o.delete_option('title'))
+        self.assertEqual(self.request(view, HTTP_IF_MODIFIED_SINCE=last_modified).status_code, 200)
+        self.assertEqual(len(self.calls), 3)
 
+    def test_condition_on_site(self):
+        self.assertTrue(self.o.add_option('title', 'Hello'))
+        view = condition_on_options(lambda request: None)(self.view)
+        response = self.request(view)
+        self.assertFalse(response.has_header('Last-Modified'))
+        self.assertEqual(self.request(view, HTTP_IF_NONE_MATCH=response['ETag']).status_code, 304)
+        self.assertTrue(self.o.add_option('other', 1))
+        self.assertEqual(self.request(view, HTTP_IF_NONE_MATCH=response['ETag']).status_code, 200)
@@ -0,0 +1,107 @@
+"""
+Immutable copies of option values, see OPTIONS_FREEZE_VALUES.
+
+Frozen dicts and lists are subclasses of dict and list, so they compare
+equal to plain ones, but every change raises TypeError. They are stored
+thawed, as plain ones.
+"""
+import copy
+import datetime
+from decimal import Decimal
+
+
+def _immutable(self, *args, **kwargs):
+    raise TypeError('%s is read-only, copy it before changing' % type(self).__name__)
+
+
+class FrozenDict(dict):
+    __slots__ = ()
+
+    __setitem__ = __delitem__ = clear = pop = popitem = setdefault = update = _immutable
+
+    def __reduce__(self):
+        return FrozenDict, (dict(self),)
+
+    def __hash__(self):
+        return hash(frozenset(self.items()))
+
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
+
+    def copy(self):
+        # a changeable copy
+        return dict(self)
+
+
+class FrozenList(list):
+    __slots__ = ()
+
+    __setitem__ = __delitem__ = __setslice__ = __delslice__ = __iadd__ = __imul__ = _immutable
+    append = extend = insert = pop = remove = reverse = sort = _immutable
+
+    def __reduce__(self):
+        return FrozenList, (list(self),)
+
+    def __hash__(self):
+        return hash(tuple(self))
+
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
+
+
+class FrozenSet(frozenset):
+    """
+    Frozen copy of a set, so it is stored again as a set.
+    """
+    __slots__ = ()
+
+
+IMMUTABLE_TYPES = frozenset([
+    bool, int, long, float, complex, str, unicode, Decimal, frozenset, FrozenDict, FrozenList, FrozenSet,
+    datetime.date, datetime.datetime, datetime.time, datetime.timedelta,
+])
+
+
+def freeze(value):
+    """
+    Immutable copy of a value, sharing its immutable parts. Values of
+    unknown types are deep copied instead, so they are still private.
+    """
+    value_type = type(value)
+    if value is None or value_type in IMMUTABLE_TYPES:
+        return value
+    if value_type is dict:
+        return FrozenDict((key, freeze(item)) for key, item in value.items())
+    if value_type is list:
+        return FrozenList(freeze(item) for item in value)
+    if value_type is tuple:
+        items = tuple(freeze(item) for item in value)
+        for item, frozen in zip(value, items):
+            if item is not frozen:
+                return items
+        return value
+    if value_type is set:
+        return FrozenSet(value)
+    return copy.deepcopy(value)
+
+
+def thaw(value):
+    """
+    Plain copy of a value with frozen parts, as stored in the database.
+    """
+    value_type = type(value)
+    if value_type in (dict, FrozenDict):
+        return dict((key, thaw(item)) for key, item in value.items())
+    if value_type in (list, FrozenList):
+        return [thaw(item) for item in value]
+    if value_type is tuple:
+        return tuple(thaw(item) for item in value)
+    if value_type is FrozenSet:
+        return set(value)
+    return value
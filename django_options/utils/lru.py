@@ -0,0 +1,116 @@
+import threading
+from collections import deque
+
+_missing = object()
+
+
+class LRUCache(object):
+    """
+    A dict-like container that holds at most ``capacity`` keys,
+    discarding the least recently used ones (unbounded if None, nothing is
+    held if not positive).
+
+    Recency is approximated with a second chance (CLOCK) policy: reads only
+    mark a key as used, so they never lock and are safe with concurrent
+    writers, which are serialized. Only ``get`` marks keys and updates
+    ``hits`` and ``misses`` counters, approximated under concurrency.
+    """
+
+    def __init__(self, capacity=None):
+        self.capacity = capacity
+        self.data = {}
+        # keys in insertion order, and keys read since their last visit
+        self.order = deque()
+        self.used = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, default=None):
+        value = self.data.get(key, _missing)
+        if value is _missing:
+            self.misses += 1
+            return default
+        if self.capacity is not None:
+            self.used[key] = True
+        self.hits += 1
+        return value
+
+    def __setitem__(self, key, value):
+        with self.lock:
+            data, capacity = self.data, self.capacity
+            if capacity is not None and key not in data:
+                if capacity <= 0:
+                    return
+                while len(data) >= capacity and self._evict():
+                    pass
+                if len(self.order) > 2 * capacity:
+                    # drop keys deleted in the meanwhile, before adding the new one
+                    self.order = deque(k for k in self.order if k in data)
+                self.order.append(key)
+            data[key] = value
+
+    def _evict(self):
+        """
+        Discard a key, returns False if there is none to discard.
+        """
+        order, used, data = self.order, self.used, self.data
+        while order:
+            key = order.popleft()
+            if key not in data:
+                continue
+            if used.pop(key, False):
+                # second chance
+                order.append(key)
+                continue
+            del data[key]
+            self.evictions += 1
+            return True
+        return False
+
+    def __getitem__(self, key):
+        return self.data[key]
+
+    def __delitem__(self, key):
+        with self.lock:
+            del self.data[key]
+            self.used.pop(key, None)
+
+    def __contains__(self, key):
+        return key in self.data
+
+    def __len__(self):
+        return len(self.data)
+
+    def __iter__(self):
+        return iter(list(self.data))
+
+    def pop(self, key, *default):
+        with self.lock:
+            self.used.pop(key, None)
+            return self.data.pop(key, *default)
+
+    def keys(self):
+        return list(self.data)
+
+    def items(self):
+        return list(self.data.items())
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+            self.order.clear()
+            self.used.clear()
+
+    def stats(self):
+        return {
+            'size': len(self.data),
+            'capacity': self.capacity,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
+
+    def __repr__(self):
+        return '<LRUCache %r>' % self.data